@@ -1,12 +1,25 @@
-from flask import Flask, abort, render_template, send_file, jsonify
+from flask import (
+    Flask,
+    abort,
+    jsonify,
+    render_template,
+    request,
+    send_file,
+    stream_template,
+)
 from mattermostdriver import Driver
 import re
+from typing import Iterator
 
 import config
 
 
 app = Flask(__name__)
 
+from app import log
+
+log.init_app(app)
+
 app.config["SQLALCHEMY_DATABASE_URI"] = config.DATABASE_URL
 # Supress Flask warning
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
@@ -19,7 +32,23 @@ mm_driver = Driver(
 )
 mm_driver.login()
 
+if config.profile_sample_rate:
+    from app.profiling import ProfilingMiddleware
+
+    app.wsgi_app = ProfilingMiddleware(
+        app.wsgi_app,
+        config.profile_dir,
+        config.profile_sample_rate,
+        config.profile_keep,
+    )
+
 DOOR_STATUS = {"0": "locked", "1": "open", "2": "inbetween"}
+# Quotes loaded from the database at a time while streaming quotes.html
+QUOTES_STREAM_BATCH = 200
+# Characters of quotes.html sent at a time
+QUOTES_STREAM_BUFFER = 16 * 1024
+# Quotes in a quotes.html?before= fragment
+QUOTES_PAGE_SIZE = 100
 
 from app import models
 
@@ -27,7 +56,13 @@ from app import models
 # @Jens plskeep
 from app import cron
 
+# Registers the flask CLI commands
+from app import commands
+
+from app import quote_export
+
 from app.routes import (
+    admin_blueprint,
     cammie_blueprint,
     door_access_blueprint,
     door_control_blueprint,
@@ -38,6 +73,7 @@ from app.routes import (
     spaceapi_blueprint,
 )
 
+app.register_blueprint(admin_blueprint)
 app.register_blueprint(cammie_blueprint)
 app.register_blueprint(door_access_blueprint)
 app.register_blueprint(door_control_blueprint)
@@ -66,9 +102,48 @@ def get_quote_css():
     return send_file("static/quotes.css")
 
 
+def buffered(chunks: Iterator[str], size: int) -> Iterator[str]:
+    """Join small chunks into ones of at least `size` characters"""
+
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield "".join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield "".join(buffer)
+
+
 @app.route("/quotes.html", methods=["GET"])
 def list_quotes():
-    return render_template("quotes.html", quotes=reversed(models.Quote.query.all()))
+    """
+    All quotes, newest first
+
+    The page is streamed while the quotes are read in batches, so it doesn't have
+    to fit in memory. With `?before=<id>` only the blockquotes of the
+    `QUOTES_PAGE_SIZE` quotes before that id are returned, to load more quotes into
+    a page that's already shown.
+    """
+
+    newest_first = models.Quote.query.order_by(models.Quote.id.desc())
+    before = request.args.get("before")
+    if before is not None:
+        if not before.isdigit():
+            return abort(400)
+        quotes = newest_first.filter(models.Quote.id < int(before))
+        return render_template(
+            "quote_list.html", quotes=quotes.limit(QUOTES_PAGE_SIZE).all()
+        )
+    page = stream_template(
+        "quotes.html", quotes=newest_first.yield_per(QUOTES_STREAM_BATCH)
+    )
+    return app.response_class(
+        buffered(page, QUOTES_STREAM_BUFFER), mimetype="text/html"
+    )
 
 
 @app.route("/quotes.json", methods=["GET"])
@@ -88,3 +163,23 @@ def json_quotes():
     )
     response.headers.add("Access-Control-Allow-Origin", "*")
     return response
+
+
+@app.route("/quotes.ndjson", methods=["GET"])
+def ndjson_quotes():
+    return quote_export.ndjson_export.response()
+
+
+@app.route("/quotes.csv", methods=["GET"])
+def csv_quotes():
+    return quote_export.csv_export.response()
+
+
+@app.route("/quotes/stats.json", methods=["GET"])
+def json_quote_stats():
+    stats = {dimension: {} for dimension in models.QuoteStat.DIMENSIONS}
+    for stat in models.QuoteStat.query.all():
+        stats[stat.dimension][stat.key] = stat.count
+    response = jsonify(stats)
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
@@ -0,0 +1,70 @@
+import threading
+import time
+from typing import Iterator, Optional
+
+
+class Broadcaster:
+    """
+    Fan out the latest value of some state to any number of waiting subscribers
+
+    Only the most recent value is kept: a subscriber that is too slow to see an
+    intermediate value simply gets the newer one. This keeps publishing O(1) and
+    costs an idle subscriber nothing but a sleeping thread.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._version = 0
+        self._value = None
+        self.published_at: Optional[float] = None
+
+    @property
+    def value(self) -> Optional[str]:
+        """The last published value, `None` if nothing was published yet"""
+
+        return self._value
+
+    def publish(self, value: str):
+        """Publish a new value and wake up all subscribers"""
+
+        with self._condition:
+            self._value = value
+            self.published_at = time.time()
+            self._version += 1
+            self._condition.notify_all()
+
+    def subscribe(self, timeout: float) -> Iterator[Optional[str]]:
+        """
+        Yield every newly published value as it arrives
+
+        Yields `None` when nothing was published for `timeout` seconds, so the
+        caller can send a heartbeat.
+        """
+
+        seen = self._version
+        while True:
+            with self._condition:
+                changed = self._condition.wait_for(
+                    lambda: self._version != seen, timeout=timeout
+                )
+                seen = self._version
+                value = self._value
+            yield value if changed else None
+
+
+_door_status_broadcasters: dict[str, Broadcaster] = {}
+_door_status_broadcasters_lock = threading.Lock()
+
+
+def door_status_broadcaster(door: str) -> Broadcaster:
+    """
+    The broadcaster of the status of a door, published by its lockbot's callbacks
+
+    Only callbacks handled by this worker are published here, the ones of other
+    workers reach it through the shared cache.
+    """
+
+    with _door_status_broadcasters_lock:
+        if door not in _door_status_broadcasters:
+            _door_status_broadcasters[door] = Broadcaster()
+        return _door_status_broadcasters[door]
@@ -0,0 +1,193 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from app.snapshot import snapshots
+
+import config
+
+
+class MemoryCache:
+    """Cache in the memory of this process, only for development with a single worker"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: dict[str, tuple[str, Optional[float]]] = {}
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None or (entry[1] is not None and entry[1] < time.time()):
+            return default
+        return entry[0]
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl if ttl else None)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def add(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        with self._lock:
+            if self.get(key) is not None:
+                return False
+            self._entries[key] = (value, time.time() + ttl if ttl else None)
+            return True
+
+    def incr(self, key: str, ttl: Optional[float] = None):
+        with self._lock:
+            count = int(self.get(key, "0")) + 1
+            self._entries[key] = (str(count), time.time() + ttl if ttl else None)
+
+    def pop(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        with self._lock:
+            value = self.get(key, default)
+            self._entries.pop(key, None)
+            return value
+
+    def items(self) -> dict[str, str]:
+        now = time.time()
+        return {
+            key: value
+            for key, (value, expires_at) in list(self._entries.items())
+            if expires_at is None or expires_at >= now
+        }
+
+    def dump(self) -> Optional[dict[str, tuple[str, Optional[float]]]]:
+        now = time.time()
+        entries = {
+            key: entry
+            for key, entry in list(self._entries.items())
+            if entry[1] is None or entry[1] >= now
+        }
+        return entries or None
+
+    def load(self, entries: dict[str, list]):
+        now = time.time()
+        with self._lock:
+            for key, (value, expires_at) in entries.items():
+                if expires_at is None or expires_at >= now:
+                    self._entries.setdefault(key, (value, expires_at))
+
+
+class SQLiteCache:
+    """
+    Cache in a local SQLite file, shared by all workers on this machine
+
+    The file is in WAL mode, so readers never wait for writers and a lookup costs a
+    few microseconds. Expired entries are purged every now and then on writes.
+    """
+
+    # Chance that a write also purges expired entries
+    PURGE_PROBABILITY = 0.01
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        row = (
+            self._connection()
+            .execute(
+                "SELECT value FROM cache WHERE key = ? "
+                "AND (expires_at IS NULL OR expires_at >= ?)",
+                (key, time.time()),
+            )
+            .fetchone()
+        )
+        return default if row is None else row[0]
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl if ttl else None),
+        )
+        if random.random() < self.PURGE_PROBABILITY:
+            connection.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+
+    def delete(self, key: str):
+        self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def add(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        """Set `key` only if it isn't set yet, returns whether it was set"""
+
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT INTO cache (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE "
+            "SET value = excluded.value, expires_at = excluded.expires_at "
+            "WHERE cache.expires_at < ?",
+            (key, value, now + ttl if ttl else None, now),
+        )
+        return cursor.rowcount == 1
+
+    def incr(self, key: str, ttl: Optional[float] = None):
+        """Add one to the counter in `key`, `ttl` counts from this increment"""
+
+        now = time.time()
+        self._connection().execute(
+            "INSERT INTO cache (key, value, expires_at) VALUES (?, '1', ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = CASE "
+            "WHEN cache.expires_at < ? THEN 1 ELSE CAST(cache.value AS INTEGER) + 1 "
+            "END, expires_at = excluded.expires_at",
+            (key, now + ttl if ttl else None, now),
+        )
+
+    def pop(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """Delete `key` and return its value, only one worker gets the value"""
+
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            value = self.get(key, default)
+            connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return value
+
+    def items(self) -> dict[str, str]:
+        return dict(
+            self._connection().execute(
+                "SELECT key, value FROM cache "
+                "WHERE expires_at IS NULL OR expires_at >= ?",
+                (time.time(),),
+            )
+        )
+
+
+def make_cache():
+    """Create the cache backend selected in the config"""
+
+    if config.cache_backend == "memory":
+        return MemoryCache()
+    if config.cache_backend == "sqlite":
+        return SQLiteCache(config.cache_path)
+    raise ValueError(f"Unknown cache backend {config.cache_backend!r}")
+
+
+shared_cache = make_cache()
+if isinstance(shared_cache, MemoryCache):
+    # The SQLite cache outlives the workers by itself
+    snapshots.register("shared_cache", shared_cache.dump, shared_cache.load)
@@ -0,0 +1,139 @@
+import logging
+import queue
+import threading
+import time
+from typing import Optional
+
+import requests
+
+from app import log
+from app.devices import TokenBucket
+from app.util import post_delayed_response
+
+CAMMIECHAT_URL = "https://kelder.zeus.ugent.be/messages/"
+# Users whose messages wait to be delivered, beyond this new messages are refused
+QUEUE_SIZE = 50
+# Messages delivered to the kelder display at the same time
+DELIVERY_WORKERS = 2
+# (messages per second, burst) a user may send
+USER_RATE_LIMIT = (0.2, 3)
+
+logger = logging.getLogger("mattermore.cammiechat")
+
+
+class _Pending:
+    __slots__ = ("texts", "response_urls", "request_id")
+
+    def __init__(self, request_id: Optional[str]):
+        self.texts: list[str] = []
+        self.response_urls: list[str] = []
+        self.request_id = request_id
+
+
+class CammiechatPipeline:
+    """
+    Deliver cammiechat messages in the background
+
+    A user's messages wait in a bounded queue and are delivered by a few worker
+    threads. Messages a user sends while an earlier one is still waiting are merged
+    into it, so a burst is a single delivery. Users that send too fast, or while the
+    queue is full, are refused right away instead of piling up.
+    """
+
+    def __init__(self, workers: int, queue_size: int, rate: float, burst: float):
+        self.workers = workers
+        self.rate = rate
+        self.burst = burst
+        self._queue: queue.Queue[str] = queue.Queue(maxsize=queue_size)
+        self._pending: dict[str, _Pending] = {}
+        self._buckets: dict[str, TokenBucket] = {}
+        self._evicted_at = 0.0
+        self._lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+
+    def submit(
+        self, username: str, text: str, response_url: Optional[str]
+    ) -> Optional[str]:
+        """Queue a message, returns why it was refused or `None` if it was queued"""
+
+        now = time.time()
+        with self._lock:
+            self._evict_idle_buckets(now)
+            pending = self._pending.get(username)
+            # Refused messages don't count towards the rate limit
+            if pending is None and self._queue.full():
+                return "Cammiechat is too busy right now, try again later"
+            bucket = self._buckets.setdefault(
+                username, TokenBucket(self.rate, self.burst)
+            )
+            if not bucket.try_take(now):
+                return "You're sending messages too fast, slow down a bit"
+            if pending is None:
+                # Only ever put while holding the lock, so there's still room
+                self._queue.put_nowait(username)
+                pending = self._pending[username] = _Pending(log.current_request_id())
+                self._start_workers()
+            pending.texts.append(text)
+            if response_url:
+                pending.response_urls.append(response_url)
+        return None
+
+    def _evict_idle_buckets(self, now: float):
+        # A bucket that filled up again is the same as a new one, so forget it
+        idle = self.burst / self.rate
+        if now < self._evicted_at + idle:
+            return
+        self._buckets = {
+            username: bucket
+            for username, bucket in self._buckets.items()
+            if now < bucket.updated_at + idle
+        }
+        self._evicted_at = now
+
+    def backlog(self) -> int:
+        """Number of users whose messages wait to be delivered"""
+
+        return self._queue.qsize()
+
+    def _start_workers(self):
+        # Started on the first message, so CLI commands don't start threads
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name="cammiechat", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        session = requests.Session()
+        while True:
+            username = self._queue.get()
+            with self._lock:
+                pending = self._pending.pop(username)
+            with log.bind_request_id(pending.request_id):
+                try:
+                    self._deliver(session, username, pending)
+                except Exception:
+                    logger.exception("delivering message failed")
+
+    def _deliver(self, session: requests.Session, username: str, pending: _Pending):
+        try:
+            with log.upstream_call("cammiechat"):
+                r = session.post(
+                    CAMMIECHAT_URL,
+                    data="\n".join(pending.texts).encode("utf8"),
+                    headers={"X-Username": username, **log.request_id_headers()},
+                    timeout=5,
+                )
+                r.raise_for_status()
+        except requests.exceptions.RequestException:
+            for response_url in pending.response_urls:
+                try:
+                    post_delayed_response(
+                        response_url,
+                        "Your message could not be delivered to cammiechat",
+                        ephemeral=True,
+                    )
+                except requests.exceptions.RequestException:
+                    pass
+
+
+cammiechat_pipeline = CammiechatPipeline(DELIVERY_WORKERS, QUEUE_SIZE, *USER_RATE_LIMIT)
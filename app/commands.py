@@ -0,0 +1,109 @@
+from datetime import date, timedelta
+
+import click
+import requests
+
+from app import menu, models
+from app.app import app
+from app.mattermost_users import mattermost_users
+from app.quote_sampler import quote_sampler
+from app.snapshot import snapshots
+
+import config
+
+# Usernames looked up in Mattermost at once by `warmup`
+WARMUP_USERS_PER_REQUEST = 100
+
+
+@app.cli.command("rebuild-quote-stats")
+def rebuild_quote_stats():
+    """Recompute the quote statistics from scratch"""
+
+    models.QuoteStat.rebuild()
+    click.echo(f"Rebuilt {models.QuoteStat.query.count()} quote statistics")
+
+
+@app.cli.command("backfill-quote-people")
+@click.option("--batch-size", default=500, show_default=True)
+def backfill_quote_people(batch_size):
+    """Link existing quotes to the people they quote"""
+
+    linked = 0
+    for count in models.Person.backfill_quotes(batch_size):
+        linked += count
+        click.echo(f"Linked {linked} quotes")
+    click.echo(f"Done, {models.Person.query.count()} people are quoted")
+
+
+@app.cli.command("add-person-alias")
+@click.argument("name")
+@click.argument("alias")
+def add_person_alias(name, alias):
+    """Let the existing person NAME also be known as ALIAS, merging them if ALIAS exists"""
+
+    if models.Quote.normalize_quotee(name) is None:
+        raise click.BadParameter("not a valid name", param_hint="NAME")
+    if models.Quote.normalize_quotee(alias) is None:
+        raise click.BadParameter("not a valid name", param_hint="ALIAS")
+    person = models.Person.find(name)
+    if person is None:
+        raise click.BadParameter(f"nobody is known as '{name}'", param_hint="NAME")
+    person.add_alias(alias)
+    click.echo(
+        f"{person.name} is known as "
+        + ", ".join(sorted(a.alias for a in person.aliases))
+    )
+
+
+@app.cli.command("add-door")
+@click.argument("name")
+@click.argument("url")
+@click.argument("down_key")
+@click.argument("up_key")
+def add_door(name, url, down_key, up_key):
+    """Add the door NAME, of which the lockbot listens on URL"""
+
+    name = name.lower()
+    if (
+        name in ("all", config.default_door)
+        or models.Door.query.filter_by(name=name).first()
+    ):
+        raise click.BadParameter(f"'{name}' is already taken", param_hint="NAME")
+    models.Door(name, url, down_key, up_key).save()
+    click.echo(f"Added door '{name}', its lockbot should call /doorkeeper/{name}")
+
+
+@app.cli.command("warmup")
+def warmup():
+    """Fill the caches, so workers that start right after a deploy start warm"""
+
+    # Door statuses are only cached for seconds, so they aren't worth warming
+    usernames = [
+        username
+        for username, in models.User.query.filter(
+            models.User.mattermost_id.isnot(None)
+        ).with_entities(models.User.username)
+    ]
+    try:
+        for start in range(0, len(usernames), WARMUP_USERS_PER_REQUEST):
+            mattermost_users.resolve(
+                usernames[start : start + WARMUP_USERS_PER_REQUEST]
+            )
+        click.echo(f"Looked up {len(usernames)} Mattermost users")
+    except requests.exceptions.RequestException as e:
+        click.echo(f"Could not look up the Mattermost users: {e}")
+    today = date.today()
+    days = [today, today + timedelta(days=1)]
+    missing = [
+        day
+        for day in days
+        if any(
+            models.RestoMenu.find(resto, day) is None
+            for resto in config.resto_endpoints
+        )
+    ]
+    menus = menu.prefetch_menus(config.resto_endpoints, missing) if missing else {}
+    click.echo(f"Fetched {len(menus)} resto menus")
+    quote_sampler.refresh()
+    snapshots.save()
+    click.echo(f"Saved a cache snapshot to {snapshots.path}")
@@ -1,25 +1,49 @@
-from app import models
+from app import menu, models, outbox, user_sync
 from app.app import mm_driver, config
 from app.app import app
+from app.cache import shared_cache
+from app.error_reporter import error_reporter
+from app.snapshot import snapshots
+from app.util import get_persistent_value, set_persistent_value
 from flask import current_app
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_SUBMITTED
 from flask_apscheduler import APScheduler
 import atexit
+import hashlib
+import logging
 import requests
+import time
 from bs4 import BeautifulSoup
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 
 DICT_NEWS_KEY = "dict_news"
 STANDARD_HEADERS = {"User-Agent": "Zeus-Scraper/1.0 (+https://zeus.ugent.be/contact/)"}
 
 DICT_NEWS_URL_BASE = "https://helpdesk.ugent.be/nieuws/"
 
-HYDRA_API_RESTO_BASE = "https://hydra.ugent.be/api/2.0/resto/menu/nl/"
+KV_KEY_RESTO_MENU_HASH = "resto_menu_last_posted_hash"
+# Number of days, starting today, of which the menus are posted
+RESTO_POSTED_DAYS = 2
+# Seconds the worker that posts a menu has it to itself
+RESTO_POST_CLAIM_TTL = 24 * 3600
 
 scheduler = APScheduler()
 
+# Start, end and outcome of the last run of each job in this worker
+job_runs: dict[str, dict] = {}
+
+logger = logging.getLogger("mattermore.cron")
+
+
+def run_soon(job_id: str):
+    """Run a scheduled job right away, instead of waiting for its next run"""
+
+    scheduler.modify_job(job_id, next_run_time=datetime.now())
+
 
 def get_dict_news():
-    r = requests.get(DICT_NEWS_URL_BASE, headers=STANDARD_HEADERS)
+    r = requests.get(DICT_NEWS_URL_BASE, headers=STANDARD_HEADERS, timeout=30)
+    r.raise_for_status()
     soup = BeautifulSoup(r.text, "html.parser")
     result = []
     for table in soup.find_all("table", ["table-newsoverview"]):
@@ -37,7 +61,7 @@ def get_dict_news():
 
 def post_dict_news(n):
     message = f'**DICT NIEUWS** op {n["date"]}: [{n["message"]}]({n["link"]})'
-    print(f"Posting {message}")
+    logger.info("posting DICT news", extra={"news_id": n["id"]})
     mm_driver.posts.create_post(
         options={"channel_id": config.sysadmin_channel_id, "message": message}
     )
@@ -45,43 +69,31 @@ def post_dict_news(n):
 
 @scheduler.task("interval", id="dict_news_task", minutes=5)
 def dict_news_task():
-    with app.app_context():
-        dict_config = models.KeyValue.query.filter_by(
-            keyname=DICT_NEWS_KEY
-        ).first() or models.KeyValue(DICT_NEWS_KEY, "111")
+    try:
         news_items = get_dict_news()
-        current_maxseen = int(dict_config.value)
-        for news_item in get_dict_news():
+    except requests.exceptions.RequestException as e:
+        error_reporter.report(
+            "dict_news",
+            f"Fetching DICT news failed\n```\n{e.__class__.__name__}: {e}\n```",
+        )
+        return
+    with app.app_context(), models.unit_of_work():
+        current_maxseen = int(get_persistent_value(DICT_NEWS_KEY, "111"))
+        for news_item in news_items:
             if news_item["id"] > current_maxseen:
                 current_maxseen = news_item["id"]
                 post_dict_news(news_item)
-        dict_config.value = str(current_maxseen)
-        dict_config.save()
+        set_persistent_value(DICT_NEWS_KEY, str(current_maxseen))
 
 
-def render_menu(menu_json):
-    rendered = f"#### Menu voor {menu_json['date']}\n"
+def render_menu(resto_menu: menu.Menu) -> str:
+    rendered = f"#### Menu voor {resto_menu.date}\n"
 
-    render_item = lambda i: f" - {i['name']}"
+    render_meals = lambda meals: "\n".join(f" - {meal.name}" for meal in meals)
 
-    soups = "\n".join(
-        map(
-            render_item,
-            filter(lambda m: m["kind"] == "soup", menu_json["meals"]),
-        )
-    )
-    mains = "\n".join(
-        map(
-            render_item,
-            filter(lambda m: m["type"] == "main", menu_json["meals"]),
-        )
-    )
-    colds = "\n".join(
-        map(
-            render_item,
-            filter(lambda m: m["type"] == "cold", menu_json["meals"]),
-        )
-    )
+    soups = render_meals(resto_menu.by_kind.get("soup", ()))
+    mains = render_meals(resto_menu.by_type.get("main", ()))
+    colds = render_meals(resto_menu.by_type.get("cold", ()))
 
     rendered += f"##### Soep\n{soups}\n##### Hoofdgerecht\n{mains}\n##### Koud\n{colds}"
     return rendered
@@ -90,33 +102,105 @@ def render_menu(menu_json):
 @scheduler.task("cron", id="resto_menu_task", hour=4)
 def resto_menu_task():
     today = date.today()
-    today_url = f"{HYDRA_API_RESTO_BASE}{today.year}/{today.month}/{today.day}.json"
-    try:
-        today_json = requests.get(today_url).json()
-        assert today_json['open']
-    except:
-        today_json = None
-
-    tomorrow = today + timedelta(days=1)
-    tomorrow_url = (
-        f"{HYDRA_API_RESTO_BASE}{tomorrow.year}/{tomorrow.month}/{tomorrow.day}.json"
-    )
-    try:
-        tomorrow_json = requests.get(tomorrow_url).json()
-        assert tomorrow_json['open']
-    except:
-        tomorrow_json = None
-
-    today_repr = render_menu(today_json) if today_json is not None else ""
-    tomorrow_repr = render_menu(tomorrow_json) if tomorrow_json is not None else ""
-
-    if (today_json is not None) or (tomorrow_json is not None):
-        requests.post(
-            config.resto_voedsels_webhook,
-            json={"text": "\n\n".join([today_repr, tomorrow_repr])},
+    days = [today + timedelta(days=n) for n in range(config.resto_prefetch_days)]
+    with app.app_context(), models.unit_of_work():
+        menus = menu.prefetch_menus(config.resto_endpoints, days)
+
+        rendered = "\n\n".join(
+            render_menu(menus[resto, day])
+            for resto in config.resto_endpoints
+            for day in days[:RESTO_POSTED_DAYS]
+            if (resto, day) in menus and menus[resto, day].open
         )
+        if not rendered:
+            return
+
+        # Don't post the same menus twice, e.g. when the job runs in multiple workers
+        rendered_hash = hashlib.sha256(rendered.encode("utf8")).hexdigest()
+        if get_persistent_value(KV_KEY_RESTO_MENU_HASH, "") == rendered_hash:
+            return
+        # Only one of the workers that see the new menus gets to post them
+        claim = f"resto_menu_post:{rendered_hash}"
+        if not shared_cache.add(claim, str(time.time()), ttl=RESTO_POST_CLAIM_TTL):
+            return
+        # Another worker might have posted them and released its claim in between
+        if get_persistent_value(KV_KEY_RESTO_MENU_HASH, "") == rendered_hash:
+            shared_cache.delete(claim)
+            return
+        try:
+            requests.post(
+                config.resto_voedsels_webhook,
+                json={"text": rendered},
+                timeout=menu.HYDRA_TIMEOUT,
+            ).raise_for_status()
+        except requests.exceptions.RequestException as e:
+            error_reporter.report(
+                "resto_webhook",
+                f"Posting the resto menu failed\n```\n{e.__class__.__name__}: {e}\n```",
+            )
+            # Let the next run try again
+            shared_cache.delete(claim)
+            return
+        set_persistent_value(KV_KEY_RESTO_MENU_HASH, rendered_hash)
+        # From now on the stored hash prevents posting these menus again, until
+        # other menus were posted: then they have to be posted again
+        models.on_commit(lambda: shared_cache.delete(claim))
+
+
+@scheduler.task("interval", id="kelderapi_outbox_task", seconds=10)
+def kelderapi_outbox_task():
+    with app.app_context(), models.unit_of_work():
+        outbox.forward_kelderapi_events()
+
+
+@scheduler.task("interval", id="error_digest_task", minutes=1)
+def error_digest_task():
+    error_reporter.flush()
+
+
+@scheduler.task("interval", id="user_sync_task", minutes=10)
+def user_sync_task():
+    with app.app_context(), models.unit_of_work():
+        try:
+            user_sync.sync_mattermost_users()
+        except requests.exceptions.RequestException as e:
+            error_reporter.report(
+                "user_sync",
+                f"Syncing Mattermost users failed\n```\n{e.__class__.__name__}: {e}\n```",
+            )
+
+
+@scheduler.task("interval", id="cache_snapshot_task", minutes=5)
+def cache_snapshot_task():
+    # Also saved on exit, this covers workers that are killed
+    snapshots.save()
+
+
+def record_job_run(event):
+    run = job_runs.setdefault(event.job_id, {})
+    if event.code == EVENT_JOB_SUBMITTED:
+        run["started_at"] = time.time()
+        return
+    run["finished_at"] = time.time()
+    run["duration"] = run["finished_at"] - run.get("started_at", run["finished_at"])
+    run["failed"] = event.code == EVENT_JOB_ERROR
+
+
+def scheduler_status() -> dict[str, dict]:
+    """When each job runs next and how its last run in this worker went"""
+
+    return {
+        job.id: {
+            "next_run_time": job.next_run_time and job.next_run_time.timestamp(),
+            **job_runs.get(job.id, {}),
+        }
+        for job in scheduler.get_jobs()
+    }
 
 
 scheduler.api_enabled = True
 scheduler.init_app(app)
+scheduler.add_listener(
+    record_job_run, EVENT_JOB_SUBMITTED | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR
+)
 scheduler.start()
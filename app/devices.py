@@ -0,0 +1,164 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import threading
+import time
+from typing import Callable, Iterator, Optional
+
+import config
+
+# (commands per second, burst) every device may receive, shared by all workers
+DEVICE_RATE_LIMITS = {"lockbot": (2, 4), "fingerprint": (4, 8)}
+
+
+class TokenBucket:
+    """Token bucket rate limiter, `rate` tokens are added per second up to `burst`"""
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        tokens: Optional[float] = None,
+        updated_at: Optional[float] = None,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst if tokens is None else tokens
+        self.updated_at = time.time() if updated_at is None else updated_at
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self, now: float) -> float:
+        """Reserve a token, returns the number of seconds to wait before using it"""
+
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def try_take(self, now: float) -> bool:
+        """Take a token if one is available right now"""
+
+        self._refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class DeviceGateway:
+    """
+    Send commands to an upstream device one at a time, across all workers
+
+    Commands wait for an exclusive lock on a file per device, which also stores the
+    device's token bucket, so the device is never sent commands faster than its rate
+    limit. Commands that only read state can be coalesced: if another worker got a
+    result while we were waiting for our turn, that result is returned instead.
+
+    The lock isn't fair, so waiting commands aren't necessarily sent in the order
+    they were issued. A command that hangs holds up all others, so `send` must time
+    out.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        os.makedirs(config.device_lock_dir, exist_ok=True)
+        self.path = os.path.join(config.device_lock_dir, f"{name}.lock")
+
+        self._metrics_lock = threading.Lock()
+        self.commands = 0
+        self.coalesced = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @contextmanager
+    def _locked_state(self) -> Iterator[dict]:
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read())
+                except ValueError:
+                    state = {}
+                yield state
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _record_wait(self, wait: float, coalesced: bool):
+        with self._metrics_lock:
+            self.commands += 1
+            self.coalesced += coalesced
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def metrics(self) -> dict:
+        with self._metrics_lock:
+            return {
+                "commands": self.commands,
+                "coalesced": self.coalesced,
+                "average_wait": self.total_wait / self.commands if self.commands else 0,
+                "max_wait": self.max_wait,
+            }
+
+    def run(self, command: str, send: Callable[[], str], coalesce: bool = False):
+        """
+        Call `send` once it's our turn and the rate limit allows it
+
+        Build timestamped payloads inside `send`, so their timestamps increase in the
+        order the device receives them.
+        """
+
+        requested_at = time.time()
+        with self._locked_state() as state:
+            if coalesce:
+                obtained_at, result = state.get("results", {}).get(command, (0, None))
+                if obtained_at >= requested_at:
+                    self._record_wait(time.time() - requested_at, coalesced=True)
+                    return result
+
+            bucket = TokenBucket(self.rate, self.burst, *state.get("bucket", ()))
+            delay = bucket.take(time.time())
+            state["bucket"] = (bucket.tokens, bucket.updated_at)
+            if delay:
+                time.sleep(delay)
+            self._record_wait(time.time() - requested_at, coalesced=False)
+
+            result = send()
+            if coalesce:
+                state.setdefault("results", {})[command] = (time.time(), result)
+            return result
+
+
+_gateways: dict[str, DeviceGateway] = {}
+_gateways_lock = threading.Lock()
+
+
+def device_gateways() -> dict[str, DeviceGateway]:
+    """The gateways this worker has used so far, by device name"""
+
+    with _gateways_lock:
+        return dict(_gateways)
+
+
+def device_gateway(name: str) -> DeviceGateway:
+    """
+    The gateway of a device, see `DEVICE_RATE_LIMITS`
+
+    One of several devices of the same kind is named "<kind>:<name>", e.g.
+    "lockbot:kelder", and gets the rate limit of its kind.
+    """
+
+    with _gateways_lock:
+        if name not in _gateways:
+            kind = name.split(":")[0]
+            _gateways[name] = DeviceGateway(name, *DEVICE_RATE_LIMITS[kind])
+        return _gateways[name]
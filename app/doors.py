@@ -0,0 +1,55 @@
+import threading
+import time
+from typing import Optional
+
+from app import models
+
+import config
+
+# Seconds the doors from the database are remembered
+DOOR_REGISTRY_TTL = 60
+
+_registry: Optional[dict[str, models.Door]] = None
+_registry_loaded_at = 0.0
+_registry_lock = threading.Lock()
+
+
+def default_door() -> models.Door:
+    """The door of which the lockbot is configured in config.py"""
+
+    return doors()[config.default_door]
+
+
+def doors() -> dict[str, models.Door]:
+    """All doors by name, the default door first"""
+
+    global _registry, _registry_loaded_at
+    with _registry_lock:
+        if _registry is None or time.time() > _registry_loaded_at + DOOR_REGISTRY_TTL:
+            registry = {
+                config.default_door: models.Door(
+                    config.default_door,
+                    config.lockbot_url,
+                    config.down_key,
+                    config.up_key,
+                )
+            }
+            for door in models.Door.query.order_by(models.Door.name):
+                models.db.session.expunge(door)
+                registry.setdefault(door.name, door)
+            _registry = registry
+            _registry_loaded_at = time.time()
+        return _registry
+
+
+def cached_doors() -> dict[str, models.Door]:
+    """The doors as they were last loaded, without ever querying the database"""
+
+    with _registry_lock:
+        return dict(_registry or {})
+
+
+def get_door(name: Optional[str] = None) -> Optional[models.Door]:
+    """The door called `name`, the default door if no name is given"""
+
+    return doors().get(name or config.default_door)
@@ -0,0 +1,79 @@
+import requests
+import time
+from typing import Optional
+
+from app.cache import shared_cache
+from app.util import mattermost_doorkeeper_message
+
+import config
+
+# Seconds a count of suppressed errors is kept after its window, for `flush`
+SUPPRESSED_GRACE = 600
+
+
+class ErrorReporter:
+    """
+    Post error messages to Mattermost, at most one per key per window
+
+    The windows are kept in the shared cache, so the limit holds for all workers
+    together. The first error of a key claims the window with a single atomic write
+    and is posted right away. Further errors in the same window only increment a
+    counter, `flush` posts a digest of them once the window is over. Reporting an
+    error never touches the database.
+    """
+
+    def __init__(self, cache, webhook: str, window: float):
+        self.cache = cache
+        self.webhook = webhook
+        self.window = window
+
+    def report(self, key: str, message: str, window: Optional[float] = None):
+        """Report an error, `window` overrides the default window length in seconds"""
+
+        window = window or self.window
+        if not self.cache.add(f"error:{key}", str(time.time()), ttl=window):
+            self.cache.incr(f"error_suppressed:{key}", ttl=window + SUPPRESSED_GRACE)
+            self.cache.set(f"error_last:{key}", message, ttl=window + SUPPRESSED_GRACE)
+            return
+        # Suppressed in the previous window, if no flush got to them yet
+        suppressed = int(self.cache.pop(f"error_suppressed:{key}", "0"))
+        if suppressed:
+            message += f"\n and {suppressed} similar error(s) suppressed before"
+        self._post(message)
+
+    def flush(self):
+        """Post a digest of every finished window that suppressed errors"""
+
+        for cache_key in self.cache.items():
+            if not cache_key.startswith("error_suppressed:"):
+                continue
+            key = cache_key.partition(":")[2]
+            if self.cache.get(f"error:{key}") is not None:
+                continue
+            # Every worker flushes, only the one that pops the count posts it
+            suppressed = int(self.cache.pop(cache_key, "0"))
+            if suppressed:
+                last_message = self.cache.get(f"error_last:{key}")
+                self._post(
+                    f"{suppressed} similar error(s) suppressed "
+                    f"(`{key}`), the last one was:\n{last_message}"
+                )
+
+    def pending(self) -> dict[str, int]:
+        """Number of suppressed errors per key that weren't posted yet"""
+
+        return {
+            cache_key.partition(":")[2]: int(value)
+            for cache_key, value in self.cache.items().items()
+            if cache_key.startswith("error_suppressed:")
+        }
+
+    def _post(self, message: str):
+        try:
+            mattermost_doorkeeper_message(message, webhook=self.webhook)
+        except requests.exceptions.RequestException:
+            # Nowhere left to report this to
+            pass
+
+
+error_reporter = ErrorReporter(shared_cache, config.debug_webhook, window=3600)
@@ -0,0 +1,123 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import threading
+import logging
+import time
+from typing import Callable, Optional
+import uuid
+
+from app import log, models
+from app.app import app
+from app.util import post_delayed_response
+
+JOB_WORKERS = 4
+# Maximum number of jobs talking to the same upstream device at the same time
+DEVICE_CONCURRENCY = {"fingerprint": 1, "lockbot": 1}
+# Number of jobs of which the status is remembered
+KEEP_JOBS = 100
+
+logger = logging.getLogger("mattermore.jobs")
+
+
+class Job:
+    """A slow task that runs in the background, its result is posted to Mattermost"""
+
+    def __init__(self, name: str, device: Optional[str], response_url: Optional[str]):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.device = device
+        self.response_url = response_url
+        # Logs of the job are attributed to the request that submitted it
+        self.request_id = log.current_request_id()
+        self.status = "queued"
+        self.result: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def __repr__(self):
+        return f"<Job {self.id} {self.name} {self.status}>"
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "device": self.device,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobRunner:
+    """Run jobs on a thread pool, limiting how many use the same device at once"""
+
+    def __init__(self, workers: int, device_concurrency: dict[str, int]):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._device_limits = {
+            device: threading.BoundedSemaphore(limit)
+            for device, limit in device_concurrency.items()
+        }
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        name: str,
+        fn: Callable[..., str],
+        *args,
+        device: Optional[str] = None,
+        response_url: Optional[str] = None,
+    ) -> Job:
+        """
+        Run `fn(*args)` in the background, in an app context and unit of work
+
+        The message it returns is posted to `response_url`, if given.
+        """
+
+        job = Job(name, device, response_url)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > KEEP_JOBS:
+                self._jobs.popitem(last=False)
+        self._pool.submit(self._run, job, fn, args)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def jobs(self) -> list[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _run(self, job: Job, fn: Callable[..., str], args: tuple):
+        with self._device_limits.get(job.device, nullcontext()):
+            job.status = "running"
+            job.started_at = time.time()
+            try:
+                with log.bind_request_id(job.request_id):
+                    with app.app_context(), models.unit_of_work():
+                        job.result = fn(*args)
+                job.status = "done"
+            except Exception:
+                logger.exception(
+                    "job failed", extra={"job": job.name, "job_id": job.id}
+                )
+                job.result = f"Something went wrong while running {job.name}"
+                job.status = "failed"
+            job.finished_at = time.time()
+        if job.response_url and job.result:
+            try:
+                post_delayed_response(job.response_url, job.result, ephemeral=True)
+            except Exception:
+                # The user never hears how the job went
+                logger.exception(
+                    "posting job result failed",
+                    extra={"job": job.name, "job_id": job.id},
+                )
+                job.status = "failed"
+
+
+job_runner = JobRunner(JOB_WORKERS, DEVICE_CONCURRENCY)
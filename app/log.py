@@ -0,0 +1,179 @@
+import atexit
+from contextlib import contextmanager
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+from typing import Optional
+import uuid
+
+from flask import Flask, g, has_request_context, request
+
+import config
+
+REQUEST_ID_HEADER = "X-Request-Id"
+
+# Attributes every LogRecord has, anything else was passed through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "request_id"}
+
+# Request id of work that runs outside of a request, e.g. a background job
+_context = threading.local()
+
+logger = logging.getLogger("mattermore")
+upstream_logger = logging.getLogger("mattermore.upstream")
+
+
+def current_request_id() -> Optional[str]:
+    """The id of the request that is being handled, `None` outside of a request"""
+
+    if has_request_context():
+        return g.get("request_id")
+    return getattr(_context, "request_id", None)
+
+
+@contextmanager
+def bind_request_id(request_id: Optional[str]):
+    """Attribute everything logged by this thread to `request_id`"""
+
+    previous = getattr(_context, "request_id", None)
+    _context.request_id = request_id
+    try:
+        yield
+    finally:
+        _context.request_id = previous
+
+
+def request_id_headers() -> dict[str, str]:
+    """Headers that pass the current request id on to an upstream service"""
+
+    request_id = current_request_id()
+    return {REQUEST_ID_HEADER: request_id} if request_id else {}
+
+
+@contextmanager
+def upstream_call(service: str, command: Optional[str] = None):
+    """Log the duration and outcome of a call to an upstream service"""
+
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        upstream_logger.warning(
+            "upstream call failed",
+            extra={
+                "service": service,
+                "command": command,
+                "duration_ms": round((time.perf_counter() - started_at) * 1000, 1),
+                "error": repr(e),
+            },
+        )
+        raise
+    upstream_logger.info(
+        "upstream call",
+        extra={
+            "service": service,
+            "command": command,
+            "duration_ms": round((time.perf_counter() - started_at) * 1000, 1),
+        },
+    )
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamp records with the current request id, in the thread that logged them"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = current_request_id()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Let through a fraction of the records up to `max_level`, and all above it"""
+
+    def __init__(self, rate: float, max_level: int = logging.INFO):
+        super().__init__()
+        self.rate = rate
+        self.max_level = max_level
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.max_level:
+            return True
+        record.sample_rate = self.rate
+        return random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Format a record as a single line of JSON, including its `extra` fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue records without ever blocking, records are dropped when the queue is full"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def sampled_logger(name: str, rate: float) -> logging.Logger:
+    """A logger of which only a fraction `rate` of the INFO and DEBUG records is kept"""
+
+    sampled = logging.getLogger(name)
+    sampled.addFilter(SamplingFilter(rate))
+    return sampled
+
+
+def init_app(app: Flask):
+    """
+    Send everything logged to the "mattermore" logger to stderr as JSON
+
+    Handlers only put records on a queue, a listener thread formats and writes them,
+    so logging never blocks a request. Every request gets an id, taken from the
+    X-Request-Id header if the client sent one, that is included in its log lines.
+    """
+
+    log_queue = queue.Queue(maxsize=config.log_queue_size)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(RequestIdFilter())
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, output)
+
+    logger.addHandler(handler)
+    logger.setLevel(config.log_level)
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+
+    @app.before_request
+    def assign_request_id():
+        g.request_id = (
+            request.headers.get(REQUEST_ID_HEADER, "")[:64] or uuid.uuid4().hex
+        )
+
+    @app.after_request
+    def send_request_id(response):
+        if "request_id" in g:
+            response.headers[REQUEST_ID_HEADER] = g.request_id
+        return response
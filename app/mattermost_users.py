@@ -0,0 +1,85 @@
+import threading
+import time
+from typing import Iterable, Optional
+
+from app.app import mm_driver
+from app.snapshot import snapshots
+
+# Seconds a username <-> id pair is remembered
+MATTERMOST_USER_TTL = 3600
+
+
+class MattermostUserResolver:
+    """
+    Resolve Mattermost usernames to user ids, many at once and cached
+
+    Usernames that aren't cached are looked up with a single request to the bulk
+    usernames endpoint. Usernames that don't exist aren't cached, they might be
+    created any moment.
+    """
+
+    def __init__(self, driver, ttl: float):
+        self.driver = driver
+        self.ttl = ttl
+        self._ids: dict[str, tuple[str, float]] = {}
+        self._usernames: dict[str, tuple[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def remember(self, user_id: str, username: str):
+        """Cache a user, e.g. one that was fetched some other way"""
+
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._ids[username] = (user_id, expires_at)
+            self._usernames[user_id] = (username, expires_at)
+
+    def forget(self, user_id: str):
+        with self._lock:
+            username, _ = self._usernames.pop(user_id, (None, 0))
+            self._ids.pop(username, None)
+
+    def _cached(self, cache: dict[str, tuple[str, float]], key: str) -> Optional[str]:
+        value, expires_at = cache.get(key, (None, 0))
+        return value if expires_at >= time.time() else None
+
+    def resolve(self, usernames: Iterable[str]) -> dict[str, str]:
+        """
+        Map usernames to user ids, usernames that don't exist are left out
+
+        Raises `requests.exceptions.RequestException` when Mattermost couldn't be
+        asked.
+        """
+
+        usernames = {username.lower() for username in usernames}
+        ids = {}
+        for username in usernames:
+            user_id = self._cached(self._ids, username)
+            if user_id is not None:
+                ids[username] = user_id
+        missing = sorted(usernames - ids.keys())
+        if missing:
+            for user in self.driver.users.get_users_by_usernames(options=missing):
+                self.remember(user["id"], user["username"])
+                ids[user["username"]] = user["id"]
+        return ids
+
+    def username(self, user_id: str) -> Optional[str]:
+        """The cached username of a user id, `None` if it isn't cached"""
+
+        return self._cached(self._usernames, user_id)
+
+    def dump(self) -> Optional[dict[str, tuple[str, float]]]:
+        with self._lock:
+            return dict(self._ids) or None
+
+    def load(self, ids: dict[str, list]):
+        now = time.time()
+        with self._lock:
+            for username, (user_id, expires_at) in ids.items():
+                if expires_at >= now:
+                    self._ids.setdefault(username, (user_id, expires_at))
+                    self._usernames.setdefault(user_id, (username, expires_at))
+
+
+mattermost_users = MattermostUserResolver(mm_driver, MATTERMOST_USER_TTL)
+snapshots.register("mattermost_users", mattermost_users.dump, mattermost_users.load)
@@ -0,0 +1,122 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from functools import lru_cache
+from itertools import chain
+import json
+from operator import attrgetter
+import requests
+from typing import Iterable, Optional
+
+from app import models
+
+HYDRA_API_RESTO_BASE = "https://hydra.ugent.be/api/2.0/resto/menu/"
+HYDRA_TIMEOUT = 10
+# Seconds a slash command waits for Hydra, Mattermost doesn't wait much longer
+HYDRA_INTERACTIVE_TIMEOUT = 5
+# Maximum number of menus fetched from Hydra at the same time
+HYDRA_FETCH_WORKERS = 4
+
+
+class Meal:
+    __slots__ = ("index", "name", "price", "kind", "type")
+
+    def __init__(self, index: int, name: str, price: str, kind: str, type_: str):
+        self.index = index
+        self.name = name
+        self.price = price
+        self.kind = kind
+        self.type = type_
+
+    def __repr__(self):
+        return f"<Meal {self.kind}/{self.type} {self.name}>"
+
+
+class Menu:
+    """
+    A menu from Hydra, with its meals partitioned by kind and by type in a single
+    pass and the longest meal name of every kind precomputed
+    """
+
+    __slots__ = ("date", "open", "vegetables", "by_kind", "by_type", "name_widths")
+
+    def __init__(self, data: dict):
+        self.date = data.get("date")
+        self.open = data["open"]
+        self.vegetables = data.get("vegetables", [])
+        self.by_kind: dict[str, list[Meal]] = {}
+        self.by_type: dict[str, list[Meal]] = {}
+        self.name_widths: dict[str, int] = {}
+        for index, meal in enumerate(data.get("meals", ())):
+            meal = Meal(
+                index, meal["name"], meal.get("price"), meal["kind"], meal.get("type")
+            )
+            self.by_kind.setdefault(meal.kind, []).append(meal)
+            self.by_type.setdefault(meal.type, []).append(meal)
+            if len(meal.name) > self.name_widths.get(meal.kind, 0):
+                self.name_widths[meal.kind] = len(meal.name)
+
+    def of_kinds(self, kinds: Iterable[str]) -> list[Meal]:
+        """All meals of the given kinds, in the order of the menu"""
+
+        groups = [self.by_kind[kind] for kind in kinds if kind in self.by_kind]
+        if len(groups) == 1:
+            return groups[0]
+        return sorted(chain.from_iterable(groups), key=attrgetter("index"))
+
+    def name_width(self, kinds: Iterable[str]) -> int:
+        """Length of the longest meal name of the given kinds"""
+
+        return max((self.name_widths.get(kind, 0) for kind in kinds), default=0)
+
+
+@lru_cache(maxsize=32)
+def parse_menu(menu_json: str) -> Menu:
+    """Parse a cached menu, the same menu is only parsed once"""
+
+    return Menu(json.loads(menu_json))
+
+
+def menu_url(resto: str, day: date) -> str:
+    return f"{HYDRA_API_RESTO_BASE}{resto}/{day.year}/{day.month}/{day.day}.json"
+
+
+def fetch_menu(resto: str, day: date, timeout: float = HYDRA_TIMEOUT) -> Optional[dict]:
+    """Fetch a menu from Hydra, returns `None` if it isn't available"""
+
+    try:
+        r = requests.get(menu_url(resto, day), timeout=timeout)
+        r.raise_for_status()
+        return r.json()
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+
+def prefetch_menus(restos: list[str], days: list[date]) -> dict[tuple[str, date], Menu]:
+    """
+    Fetch the menus of multiple restos and days concurrently and cache them
+
+    Returns the menus that could be fetched, indexed by (resto, day)
+    """
+
+    keys = [(resto, day) for resto in restos for day in days]
+    with ThreadPoolExecutor(max_workers=HYDRA_FETCH_WORKERS) as pool:
+        fetched = pool.map(lambda key: fetch_menu(*key), keys)
+        menus = {key: menu for key, menu in zip(keys, fetched) if menu is not None}
+    for (resto, day), menu in menus.items():
+        models.RestoMenu.store(resto, day, menu)
+    return {key: Menu(menu) for key, menu in menus.items()}
+
+
+def get_menu(
+    resto: str, day: date, timeout: float = HYDRA_INTERACTIVE_TIMEOUT
+) -> Optional[Menu]:
+    """Get a menu from the cache, falling back to Hydra"""
+
+    cached = models.RestoMenu.find(resto, day)
+    if cached is not None:
+        return parse_menu(cached.menu)
+    menu = fetch_menu(resto, day, timeout)
+    if menu is None:
+        return None
+    models.RestoMenu.store(resto, day, menu)
+    return Menu(menu)
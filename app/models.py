@@ -1,17 +1,61 @@
-from datetime import datetime
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime
+from flask import g, has_app_context
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
+import json
 import re
 import secrets
-from sqlalchemy import ForeignKey
-from sqlalchemy.orm import relationship
-from typing import Optional
+from sqlalchemy import ForeignKey, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, relationship
+from typing import Callable, Iterator, Optional
 
 from app.app import app
 
+import config
+
+
+def engine_options(database_url: str) -> dict:
+    """SQLAlchemy engine options for the given database, tuned from the config"""
+
+    options = {"pool_pre_ping": True}
+    if database_url.startswith("sqlite"):
+        # pysqlite doesn't pool file connections, the busy timeout is set on connect
+        return options
+    options["pool_size"] = config.DATABASE_POOL_SIZE
+    options["max_overflow"] = config.DATABASE_MAX_OVERFLOW
+    options["pool_recycle"] = config.DATABASE_POOL_RECYCLE
+    if database_url.startswith("postgresql"):
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={config.DATABASE_STATEMENT_TIMEOUT_MS}"
+        }
+    return options
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Let SQLite readers and writers run concurrently and wait for locks instead of
+    failing right away
+    """
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(config.DATABASE_URL)
+
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+if config.DATABASE_URL.startswith("sqlite"):
+    with app.app_context():
+        event.listen(db.engine, "connect", set_sqlite_pragmas)
+
 MONTHS = [
     "januari",
     "februari",
@@ -28,12 +72,96 @@ MONTHS = [
 ]
 
 
+def commit_session(immediately: bool = False):
+    """
+    Commit the session, or defer the commit to the end of the current unit of work
+
+    Use `immediately` for writes other workers need to see while this request is
+    still running.
+    """
+
+    if g.get("unit_of_work") and not immediately:
+        g.unit_of_work_pending = True
+        return
+    db.session.commit()
+
+
+def on_commit(callback: Callable[[], None]):
+    """Call `callback` once the session is committed, or never if it's rolled back"""
+
+    db.session.info.setdefault("on_commit", []).append(callback)
+
+
+@event.listens_for(Session, "after_commit")
+def run_on_commit_callbacks(session):
+    # Releasing a savepoint also fires this event
+    if not session.in_nested_transaction():
+        for callback in session.info.pop("on_commit", []):
+            callback()
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_on_commit_callbacks(session):
+    if not session.in_nested_transaction():
+        session.info.pop("on_commit", None)
+
+
+@contextmanager
+def unit_of_work():
+    """Commit everything saved inside this block at once, or nothing if it fails"""
+
+    if g.get("unit_of_work"):
+        # Part of an enclosing unit of work, which commits or rolls back for us
+        yield
+        return
+    g.unit_of_work = True
+    try:
+        yield
+    except BaseException:
+        db.session.rollback()
+        raise
+    else:
+        if g.pop("unit_of_work_pending", False):
+            db.session.commit()
+    finally:
+        g.unit_of_work = False
+
+
+@app.before_request
+def begin_request_unit_of_work():
+    g.unit_of_work = True
+    g.commit_count = 0
+
+
+@app.after_request
+def commit_request_unit_of_work(response):
+    if g.pop("unit_of_work_pending", False):
+        db.session.commit()
+    if app.debug or config.db_commit_header:
+        response.headers["X-DB-Commits"] = str(g.get("commit_count", 0))
+    return response
+
+
+@app.teardown_request
+def end_request_unit_of_work(exception):
+    if exception is not None:
+        db.session.rollback()
+    g.unit_of_work = False
+
+
+@event.listens_for(Session, "after_commit")
+def count_commit(session):
+    # Releasing a savepoint also fires this event
+    if has_app_context() and not session.in_nested_transaction():
+        g.commit_count = g.get("commit_count", 0) + 1
+
+
 class BaseModel:
-    def save(self):
-        """Save this entity to the database"""
+    def save(self, immediately: bool = False):
+        """Save this entity to the database, see `commit_session`"""
 
         db.session.add(self)
-        db.session.commit()
+        commit_session(immediately)
 
 
 class User(db.Model, BaseModel):
@@ -74,6 +202,142 @@ class User(db.Model, BaseModel):
         return db.session.query(cls).filter(cls.mattermost_id == mm_id).scalar()
 
 
+class Person(db.Model, BaseModel):
+    """Someone who is quoted, known under one or more aliases"""
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255), unique=True, nullable=False)
+    user_id = db.Column(
+        db.Integer, ForeignKey(User.id, ondelete="SET NULL"), nullable=True
+    )
+
+    user = relationship("User")
+    aliases = relationship(
+        "PersonAlias", back_populates="person", cascade="all, delete-orphan"
+    )
+
+    def __init__(self, name, user=None):
+        super()
+        self.name = name
+        self.user = user
+
+    def __repr__(self):
+        return "<Person {}>".format(self.name)
+
+    @classmethod
+    def find(cls, name: str) -> Optional["Person"]:
+        """Find a person by one of their aliases"""
+
+        return (
+            db.session.query(cls)
+            .join(PersonAlias)
+            .filter(PersonAlias.alias == Quote.normalize_quotee(name))
+            .one_or_none()
+        )
+
+    @classmethod
+    def resolve(cls, name: str) -> "Person":
+        """
+        Find a person by one of their aliases, or create them
+
+        A new person is linked to the user with the same username, if there is one.
+        """
+
+        alias = Quote.normalize_quotee(name)
+        person = cls.find(alias)
+        if person is not None:
+            return person
+        try:
+            with db.session.begin_nested():
+                user = db.session.query(User).filter(User.username == alias).first()
+                person = cls(alias, user)
+                person.aliases.append(PersonAlias(alias))
+                db.session.add(person)
+        except IntegrityError:
+            # Another worker created them first
+            return cls.find(alias)
+        return person
+
+    def add_alias(self, name: str):
+        """
+        Let this person also be known as `name`
+
+        If `name` belonged to another person, their quotes and aliases are merged
+        into this person.
+        """
+
+        alias = Quote.normalize_quotee(name)
+        other = Person.find(alias)
+        if other is None:
+            self.aliases.append(PersonAlias(alias))
+        elif other.id != self.id:
+            db.session.query(Quote).filter(Quote.person_id == other.id).update(
+                {Quote.person_id: self.id}, synchronize_session=False
+            )
+            for other_alias in list(other.aliases):
+                other_alias.person = self
+            db.session.flush()
+            db.session.delete(other)
+        commit_session()
+
+    @classmethod
+    def backfill_quotes(cls, batch_size: int) -> Iterator[int]:
+        """
+        Link the quotes that name their quotee explicitly but have no person yet to
+        that person
+
+        Quotes are handled and committed a batch at a time, the number of quotes
+        linked in each batch is yielded.
+        """
+
+        person_ids = {}
+        last_id = 0
+        while True:
+            batch = (
+                db.session.query(Quote)
+                .filter(
+                    Quote.id > last_id,
+                    Quote.person_id.is_(None),
+                    Quote.quotee.isnot(None),
+                )
+                .order_by(Quote.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not batch:
+                return
+            linked = 0
+            for quote in batch:
+                quotee, explicit = Quote.parse_quotee(quote.quote)
+                if not explicit:
+                    continue
+                if quotee not in person_ids:
+                    person_ids[quotee] = cls.resolve(quotee).id
+                quote.person_id = person_ids[quotee]
+                linked += 1
+            last_id = batch[-1].id
+            commit_session()
+            db.session.expunge_all()
+            yield linked
+
+
+class PersonAlias(db.Model, BaseModel):
+    """A normalized name under which a person is quoted"""
+
+    id = db.Column(db.Integer, primary_key=True)
+    alias = db.Column(db.String(255), unique=True, nullable=False)
+    person_id = db.Column(db.Integer, ForeignKey(Person.id), nullable=False, index=True)
+
+    person = relationship("Person", back_populates="aliases")
+
+    def __init__(self, alias):
+        super()
+        self.alias = alias
+
+    def __repr__(self):
+        return "<PersonAlias {}>".format(self.alias)
+
+
 class Quote(db.Model, BaseModel):
     id = db.Column(db.Integer, primary_key=True)
     quoter = db.Column(db.String(255), unique=False, nullable=False)
@@ -81,13 +345,17 @@ class Quote(db.Model, BaseModel):
     channel = db.Column(db.String(255), unique=False, nullable=False)
     quote = db.Column(db.String(16383), unique=False, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    person_id = db.Column(db.Integer, ForeignKey(Person.id), nullable=True, index=True)
 
-    QUOTEE_REGEX = re.compile("\W*([a-zA-Z\-_0-9]+).*")
+    person = relationship("Person")
+
+    # The first word of a quote, and the colon after it if it starts the quote
+    QUOTEE_REGEX = re.compile(r"\W*([a-zA-Z\-_0-9]+)(\s*:)?")
 
     def __repr__(self):
         return '<Quote {} "{}">'.format(self.quoter, self.quote)
 
-    def __init__(self, quoter, quote, channel, created_at=None):
+    def __init__(self, quoter, quote, channel, created_at=None, quotee=None):
         super()
         self.quoter = quoter
         self.quote = quote
@@ -96,9 +364,50 @@ class Quote(db.Model, BaseModel):
             self.created_at = datetime.utcnow()
         else:
             self.created_at = created_at
-        # Experimentally try to find quoted user
-        quotee_match = Quote.QUOTEE_REGEX.search(quote)
-        self.quotee = quotee_match.group(1) if quotee_match is not None else None
+        self.quotee = quotee
+
+    @classmethod
+    def parse_quotee(cls, text: str) -> tuple[Optional[str], bool]:
+        """
+        The quotee of a quote, and whether the quote names them explicitly
+
+        The quotee is experimentally taken to be the first word of the quote. It's
+        only explicit when the quote starts with it followed by a colon, e.g.
+        `jan: ...`, otherwise it's likely just the first word of a sentence.
+        """
+
+        match = cls.QUOTEE_REGEX.search(text)
+        if match is None:
+            return None, False
+        quotee = cls.normalize_quotee(match.group(1))
+        explicit = match.start() == 0 and match.group(2) is not None
+        return quotee, explicit and quotee is not None
+
+    @classmethod
+    def from_text(cls, quoter: str, text: str, channel: str) -> "Quote":
+        """A new quote, linked to its person if it names them explicitly"""
+
+        quotee, explicit = cls.parse_quotee(text)
+        quote = cls(quoter, text, channel, quotee=quotee)
+        if explicit:
+            quote.person = Person.resolve(quotee)
+        return quote
+
+    @staticmethod
+    def normalize_quotee(quotee: str) -> Optional[str]:
+        """Normalize a quotee, so different spellings of the same name match"""
+
+        return quotee.strip("-_").lower() or None
+
+    @classmethod
+    def of_person(cls, name: str):
+        """Query the quotes of the person known as `name`"""
+
+        return (
+            db.session.query(cls)
+            .join(PersonAlias, PersonAlias.person_id == cls.person_id)
+            .filter(PersonAlias.alias == cls.normalize_quotee(name))
+        )
 
     def slur(self):
         return self.created_at.strftime("%Y-%m-%d_%H:%M:%S")
@@ -113,6 +422,79 @@ class Quote(db.Model, BaseModel):
         )
 
 
+class QuoteStat(db.Model, BaseModel):
+    """Precomputed number of quotes per quoter, quotee, channel and month"""
+
+    id = db.Column(db.Integer, primary_key=True)
+    dimension = db.Column(db.String(16), nullable=False)
+    key = db.Column(db.String(255), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.UniqueConstraint("dimension", "key"),)
+
+    DIMENSIONS = ("quoter", "quotee", "channel", "month")
+
+    def __init__(self, dimension, key, count=0):
+        super()
+        self.dimension = dimension
+        self.key = key
+        self.count = count
+
+    def __repr__(self):
+        return "<QuoteStat {}={} {}>".format(self.dimension, self.key, self.count)
+
+    @staticmethod
+    def keys_for(quoter, quotee, channel, created_at):
+        """The (dimension, key) pairs a quote is counted under"""
+
+        keys = [("quoter", quoter), ("channel", channel)]
+        if quotee is not None:
+            keys.append(("quotee", quotee))
+        keys.append(("month", created_at.strftime("%Y-%m")))
+        return keys
+
+    @classmethod
+    def count_quote(cls, quote: Quote):
+        """Add a new quote to the statistics"""
+
+        for dimension, key in cls.keys_for(
+            quote.quoter, quote.quotee, quote.channel, quote.created_at
+        ):
+            # Increment in SQL, so concurrent workers don't lose updates
+            updated = (
+                db.session.query(cls)
+                .filter(cls.dimension == dimension, cls.key == key)
+                .update({cls.count: cls.count + 1}, synchronize_session=False)
+            )
+            if updated:
+                continue
+            try:
+                with db.session.begin_nested():
+                    db.session.add(cls(dimension, key, 1))
+            except IntegrityError:
+                # Another worker inserted the group first
+                db.session.query(cls).filter(
+                    cls.dimension == dimension, cls.key == key
+                ).update({cls.count: cls.count + 1}, synchronize_session=False)
+        commit_session()
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute all statistics from the quotes table"""
+
+        counts = Counter()
+        rows = db.session.query(
+            Quote.quoter, Quote.quotee, Quote.channel, Quote.created_at
+        ).yield_per(1000)
+        for row in rows:
+            counts.update(cls.keys_for(*row))
+        db.session.query(cls).delete()
+        db.session.add_all(
+            cls(dimension, key, count) for (dimension, key), count in counts.items()
+        )
+        commit_session()
+
+
 class KeyValue(db.Model, BaseModel):
     id = db.Column(db.Integer, primary_key=True)
     keyname = db.Column(db.String(255), unique=True, nullable=False)
@@ -154,7 +536,7 @@ class Fingerprint(db.Model, BaseModel):
     @classmethod
     def create(cls, id_: int, user_id: int, note: str, created_on: datetime):
         db.session.add(cls(id_, user_id, note, created_on))
-        db.session.commit()
+        commit_session()
 
     @classmethod
     def clear_inactive(cls):
@@ -165,7 +547,7 @@ class Fingerprint(db.Model, BaseModel):
         for fp in fps:
             db.session.delete(fp)
 
-        db.session.commit()
+        commit_session()
 
         return list(map(lambda f: f.id, fps))
 
@@ -187,4 +569,113 @@ class Fingerprint(db.Model, BaseModel):
 
     def delete_(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_session()
+
+
+class RestoMenu(db.Model, BaseModel):
+    """A menu fetched from Hydra, so each day is only fetched once"""
+
+    id = db.Column(db.Integer, primary_key=True)
+    resto = db.Column(db.String(32), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    menu = db.Column(db.Text, nullable=False)
+    fetched_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint("resto", "date"),)
+
+    def __init__(self, resto: str, date_: date, menu: dict):
+        super()
+        self.resto = resto
+        self.date = date_
+        self.menu = json.dumps(menu)
+
+    def __repr__(self):
+        return "<RestoMenu {} {}>".format(self.resto, self.date)
+
+    @classmethod
+    def find(cls, resto: str, date_: date) -> Optional["RestoMenu"]:
+        return (
+            db.session.query(cls).filter(cls.resto == resto, cls.date == date_).scalar()
+        )
+
+    @classmethod
+    def store(cls, resto: str, date_: date, menu: dict):
+        """Insert or replace the menu of a resto on some day"""
+
+        cached = cls.find(resto, date_)
+        if cached is None:
+            db.session.add(cls(resto, date_, menu))
+        else:
+            cached.menu = json.dumps(menu)
+            cached.fetched_at = datetime.utcnow()
+        commit_session()
+
+
+class OutboxEvent(db.Model, BaseModel):
+    """An event that still has to be forwarded to an upstream service"""
+
+    id = db.Column(db.Integer, primary_key=True)
+    destination = db.Column(db.String(32), nullable=False, index=True)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __init__(self, destination: str, payload: dict):
+        super()
+        self.destination = destination
+        self.payload = json.dumps(payload)
+        self.created_at = datetime.utcnow()
+        self.attempts = 0
+        self.next_attempt_at = self.created_at
+
+    def __repr__(self):
+        return "<OutboxEvent {} {} {}>".format(self.id, self.destination, self.payload)
+
+    @classmethod
+    def due(cls, destination: str, limit: int) -> list["OutboxEvent"]:
+        """
+        The oldest events for a destination, if the oldest one may be retried
+
+        Events are delivered in order, so a failing event holds back the ones after it.
+        """
+
+        events = (
+            db.session.query(cls)
+            .filter(cls.destination == destination)
+            .order_by(cls.id)
+            .limit(limit)
+            .all()
+        )
+        if events and events[0].next_attempt_at > datetime.utcnow():
+            return []
+        return events
+
+    @classmethod
+    def pending(cls, destination: str) -> int:
+        return db.session.query(cls).filter(cls.destination == destination).count()
+
+
+class Door(db.Model, BaseModel):
+    """
+    A door with its own lockbot, besides the default door from the config
+
+    `down_key` signs the commands we send to its lockbot, `up_key` the callbacks it
+    sends to /doorkeeper/<name>.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(32), unique=True, nullable=False)
+    url = db.Column(db.String(255), nullable=False)
+    down_key = db.Column(db.String(255), nullable=False)
+    up_key = db.Column(db.String(255), nullable=False)
+
+    def __init__(self, name: str, url: str, down_key: str, up_key: str):
+        super()
+        self.name = name
+        self.url = url
+        self.down_key = down_key
+        self.up_key = up_key
+
+    def __repr__(self):
+        return "<Door {} {}>".format(self.name, self.url)
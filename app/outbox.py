@@ -0,0 +1,104 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import fcntl
+import json
+import os
+import requests
+import traceback
+from typing import Iterator
+
+from app import models
+from app.error_reporter import error_reporter
+
+import config
+
+KELDERAPI = "kelderapi"
+
+# Number of events delivered per run of the forwarder
+BATCH_SIZE = 50
+# Retry after 5s, 10s, 20s, ... up to an hour, and give up after a day or so
+BACKOFF_BASE = timedelta(seconds=5)
+BACKOFF_MAX = timedelta(hours=1)
+MAX_ATTEMPTS = 35
+
+# Number of undelivered events per destination, as of the last forwarder run
+backlog: dict[str, int] = {}
+
+
+def queue_event(destination: str, payload: dict):
+    """Durably queue an event for the forwarder"""
+
+    # Committed right away, so it survives errors later in the request
+    models.OutboxEvent(destination, payload).save(immediately=True)
+
+
+@contextmanager
+def forwarder_lock(destination: str) -> Iterator[bool]:
+    """Only one worker forwards a destination at a time, yields if we got the lock"""
+
+    os.makedirs(config.device_lock_dir, exist_ok=True)
+    path = os.path.join(config.device_lock_dir, f"outbox-{destination}.lock")
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def post_to_kelderapi(session: requests.Session, payload: dict):
+    r = session.post(
+        config.kelderapi_doorkeeper_url,
+        json=payload,
+        headers={"Token": config.kelderapi_doorkeeper_key},
+        timeout=10,
+    )
+    try:
+        r.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        raise requests.exceptions.HTTPError(
+            f"Kelderapi returned HTTP {r.status_code}: {e}\n\n{r.text}"
+        ) from e
+
+
+def forward_kelderapi_events():
+    """
+    Deliver queued events to kelderapi in order, over a single connection
+
+    Stops at the first failure, that event is retried with exponential backoff.
+    Must run in an app context.
+    """
+
+    with forwarder_lock(KELDERAPI) as locked:
+        if not locked:
+            return
+        events = models.OutboxEvent.due(KELDERAPI, BATCH_SIZE)
+        with requests.Session() as session:
+            for event in events:
+                payload = json.loads(event.payload)
+                try:
+                    post_to_kelderapi(session, payload)
+                except Exception as e:
+                    event.attempts += 1
+                    event.next_attempt_at = datetime.utcnow() + min(
+                        BACKOFF_BASE * 2 ** (event.attempts - 1), BACKOFF_MAX
+                    )
+                    if isinstance(e, requests.exceptions.RequestException):
+                        details = f"{e.__class__.__name__}: {e}"
+                    else:
+                        details = traceback.format_exc()
+                    message = f"Posting `{payload}` to kelderapi failed (attempt {event.attempts})\n```\n{details}\n```"
+                    if event.attempts >= MAX_ATTEMPTS:
+                        models.db.session.delete(event)
+                        message += "\nGave up on this event"
+                    error_reporter.report(KELDERAPI, message)
+                    break
+                models.db.session.delete(event)
+                # Don't deliver an event twice if a later one crashes the forwarder
+                models.commit_session(immediately=True)
+        models.commit_session(immediately=True)
+        backlog[KELDERAPI] = models.OutboxEvent.pending(KELDERAPI)
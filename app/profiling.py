@@ -0,0 +1,153 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# SQL queries of the request being profiled on this thread, None when not profiling
+_local = threading.local()
+
+PROFILE_NAME_REGEX = re.compile(r"[0-9]{8}-[0-9]{6}\.[0-9]{3}-[0-9]+-[A-Za-z0-9_.-]+")
+
+
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, "queries", None) is not None:
+        conn.info.setdefault("profiling_started_at", []).append(time.perf_counter())
+
+
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    queries = getattr(_local, "queries", None)
+    if queries is not None and conn.info.get("profiling_started_at"):
+        started_at = conn.info["profiling_started_at"].pop()
+        queries.append(
+            {"statement": statement, "duration": time.perf_counter() - started_at}
+        )
+
+
+class ProfilingMiddleware:
+    """
+    WSGI middleware that profiles a random fraction of requests
+
+    A sampled request is run under cProfile while the duration of its SQL queries is
+    recorded. Both are written to `directory`, of which only the newest `keep`
+    profiles are kept.
+    """
+
+    def __init__(self, wsgi_app, directory: str, sample_rate: float, keep: int):
+        self.wsgi_app = wsgi_app
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        # Only time queries when profiling is enabled
+        for identifier, listener in (
+            ("before_cursor_execute", _query_started),
+            ("after_cursor_execute", _query_finished),
+        ):
+            if not event.contains(Engine, identifier, listener):
+                event.listen(Engine, identifier, listener)
+
+    def __call__(self, environ, start_response):
+        if random.random() >= self.sample_rate:
+            return self.wsgi_app(environ, start_response)
+
+        profiler = cProfile.Profile()
+        _local.queries = queries = []
+        started_at = time.perf_counter()
+        try:
+            return profiler.runcall(self.wsgi_app, environ, start_response)
+        finally:
+            duration = time.perf_counter() - started_at
+            _local.queries = None
+            self._save(environ, profiler, queries, duration)
+
+    def _save(
+        self, environ, profiler: cProfile.Profile, queries: list, duration: float
+    ):
+        path = environ.get("PATH_INFO", "")
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", path).strip("_")[:60] or "root"
+        now = time.time()
+        timestamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+        # Milliseconds keep the names, and thus the rotation, in chronological order
+        name = f"{timestamp}.{int(now * 1000) % 1000:03d}-{int(duration * 1000)}-{slug}"
+        base = os.path.join(self.directory, name)
+        profiler.dump_stats(base + ".prof")
+        with open(base + ".json", "w") as f:
+            json.dump(
+                {
+                    "method": environ.get("REQUEST_METHOD"),
+                    "path": path,
+                    "duration": duration,
+                    "queries": queries,
+                },
+                f,
+            )
+        self._rotate()
+
+    def _rotate(self):
+        profiles = sorted(f for f in os.listdir(self.directory) if f.endswith(".prof"))
+        for old in profiles[: -self.keep]:
+            for extension in (".prof", ".json"):
+                try:
+                    os.remove(os.path.join(self.directory, old[:-5] + extension))
+                except FileNotFoundError:
+                    pass
+
+
+def list_profiles(directory: str) -> list[dict]:
+    """Summaries of the stored profiles, newest first"""
+
+    profiles = []
+    for filename in sorted(os.listdir(directory), reverse=True):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        profiles.append(
+            {
+                "name": filename[:-5],
+                "method": meta["method"],
+                "path": meta["path"],
+                "duration": meta["duration"],
+                "queries": len(meta["queries"]),
+                "query_duration": sum(q["duration"] for q in meta["queries"]),
+            }
+        )
+    return profiles
+
+
+def render_profile(directory: str, name: str, limit: int = 40) -> Optional[str]:
+    """Render a stored profile as text, `None` if it doesn't exist"""
+
+    if not PROFILE_NAME_REGEX.fullmatch(name):
+        return None
+    base = os.path.join(directory, name)
+    try:
+        with open(base + ".json") as f:
+            meta = json.load(f)
+        out = io.StringIO()
+        pstats.Stats(base + ".prof", stream=out).sort_stats("cumulative").print_stats(
+            limit
+        )
+    except (OSError, ValueError):
+        return None
+
+    rendered = (
+        f"{meta['method']} {meta['path']} took {meta['duration'] * 1000:.1f} ms\n\n"
+    )
+    rendered += f"{len(meta['queries'])} SQL queries:\n"
+    for query in meta["queries"]:
+        statement = " ".join(query["statement"].split())
+        rendered += f"{query['duration'] * 1000:8.2f} ms  {statement}\n"
+    return rendered + "\n" + out.getvalue()
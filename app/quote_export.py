@@ -0,0 +1,199 @@
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import gzip
+import io
+import json
+import threading
+from typing import Callable, Optional
+
+from flask import Response, abort, request
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from app import models
+from app.app import app
+
+# Supported content encodings, in order of preference
+COMPRESSORS: dict[str, Callable[[bytes], bytes]] = {}
+if brotli is not None:
+    COMPRESSORS["br"] = brotli.compress
+COMPRESSORS["gzip"] = lambda body: gzip.compress(body, compresslevel=9, mtime=0)
+
+COLUMNS = ("id", "quoter", "quotee", "channel", "quote", "created_at")
+
+# Renders and compresses the exports off the request path
+_export_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+
+
+def _quote_rows(after: int = 0) -> list[tuple]:
+    return (
+        models.db.session.query(*(getattr(models.Quote, c) for c in COLUMNS))
+        .filter(models.Quote.id > after)
+        .order_by(models.Quote.id)
+        .all()
+    )
+
+
+def _quotes_version() -> tuple[int, int]:
+    max_id, count = models.db.session.query(
+        func.max(models.Quote.id), func.count(models.Quote.id)
+    ).one()
+    return max_id or 0, count
+
+
+def render_ndjson(rows: list[tuple]) -> bytes:
+    """One JSON object per quote, oldest first, so new quotes are appended at the end"""
+
+    lines = []
+    for row in rows:
+        quote = dict(zip(COLUMNS, row))
+        quote["created_at"] = quote["created_at"].isoformat()
+        lines.append(json.dumps(quote, ensure_ascii=False) + "\n")
+    return "".join(lines).encode("utf8")
+
+
+def render_csv(rows: list[tuple]) -> bytes:
+    """A CSV file with a header row, oldest quote first"""
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(COLUMNS)
+    for row in rows:
+        writer.writerow(row[:-1] + (row[-1].isoformat(),))
+    return out.getvalue().encode("utf8")
+
+
+class QuoteExport:
+    """
+    An export of all quotes, only regenerated when the quotes change
+
+    The body and its compressed versions are kept in memory. They're regenerated in
+    the background after quotes were added or deleted. A worker that finds its
+    export outdated renders the body for the request, but compresses it in the
+    background, until then clients get it uncompressed.
+    """
+
+    def __init__(self, render: Callable[[list[tuple]], bytes], mimetype: str):
+        self.render = render
+        self.mimetype = mimetype
+        self._version: Optional[tuple[int, int]] = None
+        self._bodies: dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def _compress(self, version: tuple[int, int], body: bytes):
+        for encoding, compress in COMPRESSORS.items():
+            compressed = compress(body)
+            with self._lock:
+                if self._version != version:
+                    return
+                self._bodies[encoding] = compressed
+
+    def _render(self, version: tuple[int, int]) -> bytes:
+        body = self.render(_quote_rows())
+        with self._lock:
+            self._version = version
+            self._bodies = {"identity": body}
+        return body
+
+    def regenerate(self):
+        """Render and compress the export if the quotes changed, blocks"""
+
+        version = _quotes_version()
+        with self._lock:
+            if version == self._version:
+                return
+        self._compress(version, self._render(version))
+
+    def bodies(self) -> tuple[str, dict[str, bytes]]:
+        """The version of the export, and its bodies by encoding that are ready"""
+
+        version = _quotes_version()
+        tag = f"{version[0]}-{version[1]}"
+        with self._lock:
+            if version == self._version:
+                return tag, dict(self._bodies)
+        body = self._render(version)
+        _export_pool.submit(self._compress, version, body)
+        return tag, {"identity": body}
+
+    def response(self) -> Response:
+        """
+        A response with the export, compressed as the client prefers
+
+        ETags are supported, and Range requests on the uncompressed export. A client
+        that has an older export can also fetch just the newer quotes with
+        `?after=<id of the last quote it has>`.
+        """
+
+        after = request.args.get("after")
+        if after is not None:
+            if not after.isdigit():
+                return abort(400)
+            response = Response(
+                self.render(_quote_rows(int(after))), mimetype=self.mimetype
+            )
+            response.headers.add("Access-Control-Allow-Origin", "*")
+            return response
+
+        version, bodies = self.bodies()
+        if request.range is not None:
+            # Offsets in a compressed body are of no use to the client
+            encoding = "identity"
+        else:
+            encoding = (
+                request.accept_encodings.best_match(
+                    [encoding for encoding in COMPRESSORS if encoding in bodies]
+                    + ["identity"]
+                )
+                or "identity"
+            )
+        body = bodies[encoding]
+        response = Response(body, mimetype=self.mimetype)
+        response.set_etag(
+            version if encoding == "identity" else f"{version}-{encoding}"
+        )
+        if encoding != "identity":
+            response.content_encoding = encoding
+        response.vary.add("Accept-Encoding")
+        response.headers.add("Access-Control-Allow-Origin", "*")
+        return response.make_conditional(
+            request,
+            accept_ranges=encoding == "identity",
+            complete_length=len(body),
+        )
+
+
+ndjson_export = QuoteExport(render_ndjson, "application/x-ndjson")
+csv_export = QuoteExport(render_csv, "text/csv")
+
+
+def regenerate_exports():
+    with app.app_context():
+        for export in (ndjson_export, csv_export):
+            export.regenerate()
+
+
+@event.listens_for(models.Quote, "after_insert")
+@event.listens_for(models.Quote, "after_delete")
+def mark_quotes_changed(mapper, connection, target):
+    Session.object_session(target).info["quotes_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def regenerate_changed_exports(session):
+    if not session.in_nested_transaction() and session.info.pop(
+        "quotes_changed", False
+    ):
+        _export_pool.submit(regenerate_exports)
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_quotes_changed(session):
+    # Rolling back a savepoint doesn't undo the changes made before it
+    if not session.in_nested_transaction():
+        session.info.pop("quotes_changed", None)
@@ -0,0 +1,109 @@
+from array import array
+from collections import OrderedDict
+import random
+import threading
+from typing import Optional, Sequence
+
+from sqlalchemy import func
+
+from app import models
+from app.snapshot import snapshots
+
+# Number of quotes per channel that aren't shown again if there are others left
+RECENT_PER_CHANNEL = 20
+# Number of channels of which the recently shown quotes are remembered
+RECENT_CHANNELS = 100
+# Draws before giving up on finding a quote that wasn't shown recently
+MAX_DRAWS = 8
+
+
+class QuoteSampler:
+    """
+    Pick random quotes without loading them all
+
+    The ids of all quotes are kept in memory, and extended with the new ones when
+    the highest quote id changes. Quotes that were recently shown in a channel are
+    avoided there, as long as there are other quotes to pick from.
+    """
+
+    def __init__(self):
+        self._ids = array("q")
+        self._recent: OrderedDict[str, OrderedDict[int, None]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def dump(self) -> Optional[list[int]]:
+        return self._ids.tolist() or None
+
+    def load(self, ids: list[int]):
+        # Quotes added since are picked up by the next refresh
+        with self._lock:
+            if not self._ids:
+                self._ids = array("q", ids)
+
+    def refresh(self, reload: bool = False):
+        """Load the ids of the quotes that were added since the last refresh"""
+
+        max_id = models.db.session.query(func.max(models.Quote.id)).scalar() or 0
+        with self._lock:
+            if reload or (self._ids and max_id < self._ids[-1]):
+                self._ids = array("q")
+            last_id = self._ids[-1] if self._ids else 0
+            if max_id == last_id:
+                return
+            new_ids = (
+                models.db.session.query(models.Quote.id)
+                .filter(models.Quote.id > last_id)
+                .order_by(models.Quote.id)
+            )
+            self._ids.extend(quote_id for quote_id, in new_ids)
+
+    def _recent_in(self, channel: str) -> OrderedDict[int, None]:
+        recent = self._recent.get(channel)
+        if recent is None:
+            recent = self._recent[channel] = OrderedDict()
+            if len(self._recent) > RECENT_CHANNELS:
+                self._recent.popitem(last=False)
+        else:
+            self._recent.move_to_end(channel)
+        return recent
+
+    def choose(self, ids: Sequence[int], channel: str) -> Optional[int]:
+        """Pick one of `ids` that wasn't shown recently in `channel` if possible"""
+
+        if not ids:
+            return None
+        with self._lock:
+            recent = self._recent_in(channel)
+            for _ in range(MAX_DRAWS):
+                quote_id = random.choice(ids)
+                if quote_id not in recent or len(recent) >= len(ids):
+                    break
+            recent[quote_id] = None
+            recent.move_to_end(quote_id)
+            if len(recent) > RECENT_PER_CHANNEL:
+                recent.popitem(last=False)
+        return quote_id
+
+    def random_quote(self, channel: str) -> Optional["models.Quote"]:
+        """A random quote, `None` if there are none"""
+
+        self.refresh()
+        quote_id = self.choose(self._ids, channel)
+        quote = models.db.session.get(models.Quote, quote_id) if quote_id else None
+        if quote_id is not None and quote is None:
+            # The quote was deleted, forget about it
+            self.refresh(reload=True)
+            quote_id = self.choose(self._ids, channel)
+            quote = models.db.session.get(models.Quote, quote_id) if quote_id else None
+        return quote
+
+    def random_quote_of(self, query, channel: str) -> Optional["models.Quote"]:
+        """A random quote out of the quotes matched by `query`"""
+
+        ids = [quote_id for quote_id, in query.with_entities(models.Quote.id)]
+        quote_id = self.choose(ids, channel)
+        return models.db.session.get(models.Quote, quote_id) if quote_id else None
+
+
+quote_sampler = QuoteSampler()
+snapshots.register("quote_ids", quote_sampler.dump, quote_sampler.load)
@@ -1,3 +1,4 @@
+from .admin import admin_blueprint
 from .cammie import cammie_blueprint
 from .door_access import door_access_blueprint
 from .door_control import door_control_blueprint
@@ -0,0 +1,79 @@
+from flask import Blueprint, Response, abort, jsonify, render_template, request
+import time
+
+import config
+from app import cron, outbox, profiling
+from app.broadcast import door_status_broadcaster
+from app.cache import shared_cache
+from app.cammiechat import cammiechat_pipeline
+from app.devices import device_gateways
+from app.doors import cached_doors
+from app.error_reporter import error_reporter
+from app.jobs import job_runner
+from app.routes.fingerprint import fingerprint_slots
+from app.util import requires_bearer_token
+
+
+admin_blueprint = Blueprint("admin", __name__, url_prefix="/admin")
+
+
+def status() -> dict:
+    """
+    The internal state of this worker
+
+    Only in-memory state and the shared cache are read, never the database or the
+    devices, so this is cheap enough to poll every few seconds.
+    """
+
+    now = time.time()
+    door_statuses = {}
+    for name in cached_doors() or [config.default_door]:
+        broadcaster = door_status_broadcaster(name)
+        door_statuses[name] = {
+            "status": broadcaster.value,
+            "age": broadcaster.published_at and now - broadcaster.published_at,
+        }
+    return {
+        "time": now,
+        "doors": door_statuses,
+        "cache": shared_cache.items(),
+        "scheduler": cron.scheduler_status(),
+        "outbox_backlog": outbox.backlog,
+        "cammiechat_backlog": cammiechat_pipeline.backlog(),
+        "suppressed_errors": error_reporter.pending(),
+        "device_gateways": {
+            name: gateway.metrics() for name, gateway in device_gateways().items()
+        },
+        "jobs": [job.as_dict() for job in job_runner.jobs()],
+        "fingerprint_slots": fingerprint_slots,
+    }
+
+
+@admin_blueprint.route("/status", methods=["GET"])
+@requires_bearer_token("admin", browser=True)
+def show_status():
+    # Clients that accept anything, like curl, get JSON
+    if (
+        request.accept_mimetypes.best_match(["application/json", "text/html"])
+        == "text/html"
+    ):
+        return render_template("admin_status.html", status=status())
+    return jsonify(status())
+
+
+@admin_blueprint.route("/profiles", methods=["GET"])
+@requires_bearer_token("admin")
+def list_profiles():
+    try:
+        return jsonify(profiling.list_profiles(config.profile_dir))
+    except FileNotFoundError:
+        return jsonify([])
+
+
+@admin_blueprint.route("/profiles/<name>", methods=["GET"])
+@requires_bearer_token("admin")
+def show_profile(name):
+    rendered = profiling.render_profile(config.profile_dir, name)
+    if rendered is None:
+        return abort(404)
+    return Response(rendered, mimetype="text/plain")
@@ -1,21 +1,28 @@
 from flask import Blueprint, request
-import requests
 
-from app.util import mattermost_response, requires_regular, requires_token
+from app.cammiechat import cammiechat_pipeline
+from app.util import (
+    StaticResponse,
+    mattermost_response,
+    requires_regular,
+    requires_token,
+)
 
 
 cammie_blueprint = Blueprint("cammie", __name__)
 
+MESSAGE_SENT = StaticResponse("Message sent", ephemeral=True)
+
 
 @cammie_blueprint.route("/cammiechat", methods=["POST"])
 @requires_token("cammiechat")
 @requires_regular
 def cammiechat(user):
-    headers = {"X-Username": user.username}
-    requests.post(
-        "https://kelder.zeus.ugent.be/messages/",
-        data=request.values.get("text").strip(),
-        headers=headers,
-        timeout=5,
+    refused = cammiechat_pipeline.submit(
+        user.username,
+        request.values.get("text").strip(),
+        request.values.get("response_url"),
     )
-    return mattermost_response("Message sent", ephemeral=True)
+    if refused:
+        return mattermost_response(refused, ephemeral=True)
+    return MESSAGE_SENT()
@@ -1,9 +1,14 @@
 from flask import Blueprint, request
+import requests
+from sqlalchemy import event, or_
+import time
+from typing import Optional
 
 from app import models
+from app.mattermost_users import mattermost_users
 from app.util import (
+    StaticResponse,
     get_actual_username,
-    get_mattermost_id,
     mattermost_response,
     requires_admin,
     requires_token,
@@ -12,74 +17,158 @@ from app.util import (
 
 door_access_blueprint = Blueprint("door_access_blueprint", __name__)
 
+REVOKE_USAGE = StaticResponse("To revoke users: /revoke username...", ephemeral=True)
+MATTERMOST_UNAVAILABLE = StaticResponse(
+    "Could not reach Mattermost to look up the users, try again later", ephemeral=True
+)
+
+# Other workers don't see our invalidations, so don't keep the listing forever
+AUTHORIZED_USERS_TTL = 60
+
+_authorized_users: Optional[StaticResponse] = None
+_authorized_users_rendered_at = 0.0
+
+
+def authorized_users_response() -> StaticResponse:
+    """The listing of authorized users, rendered again only when users changed"""
+
+    global _authorized_users, _authorized_users_rendered_at
+    if (
+        _authorized_users is None
+        or time.time() > _authorized_users_rendered_at + AUTHORIZED_USERS_TTL
+    ):
+        _authorized_users = StaticResponse(
+            "\n".join(
+                f'{"**" if u.admin else ""}{u.username}{" ADMIN**" if u.admin else ""}'
+                for u in models.User.query.filter_by(authorized=True).order_by(
+                    models.User.username
+                )
+            ),
+            ephemeral=True,
+        )
+        _authorized_users_rendered_at = time.time()
+    return _authorized_users
+
+
+def invalidate_authorized_users(mapper, connection, target):
+    global _authorized_users
+    _authorized_users = None
+
+
+for user_event in ("after_insert", "after_update", "after_delete"):
+    event.listen(models.User, user_event, invalidate_authorized_users)
+
+
+def find_users(
+    mattermost_ids: dict[str, str]
+) -> tuple[dict[str, models.User], set[str]]:
+    """
+    The users with the given Mattermost ids indexed by username, and the usernames
+    that belong to a different Mattermost account in our database
+    """
+
+    users = models.User.query.filter(
+        or_(
+            models.User.mattermost_id.in_(mattermost_ids.values()),
+            models.User.username.in_(mattermost_ids.keys()),
+        )
+    ).all()
+    by_mattermost_id = {user.mattermost_id: user for user in users}
+    by_username = {user.username: user for user in users}
+    found = {}
+    conflicts = set()
+    for username, mattermost_id in mattermost_ids.items():
+        user = by_mattermost_id.get(mattermost_id)
+        if user is None:
+            user = by_username.get(username)
+            if user is not None and user.mattermost_id is not None:
+                # The username now belongs to another account than the stored one
+                conflicts.add(username)
+                continue
+        if user is not None:
+            # Users added before Mattermost ids were stored are found by username
+            found[username] = user
+    return found, conflicts
+
 
 @door_access_blueprint.route("/authorize", methods=["POST"])
 @requires_token("authorize")
 @requires_admin
 def authorize(admin_user):
-    """Slash-command to authorize a new user or modify an existing user"""
+    """Slash-command to authorize new users or modify existing users"""
 
     tokens = request.values.get("text").strip().split()
     if not tokens:
         # list authorized user
-        response = "\n".join(
-            f'{"**" if u.admin else ""}{u.username}{" ADMIN**" if u.admin else ""}'
-            for u in models.User.query.filter_by(authorized=True).order_by(
-                models.User.username
+        return authorized_users_response()()
+    # A user named admin is written as @admin, or authorized on its own
+    as_admin = len(tokens) > 1 and tokens[-1] == "admin"
+    if as_admin:
+        tokens = tokens[:-1]
+    usernames = [get_actual_username(token).lower() for token in tokens]
+    try:
+        mattermost_ids = mattermost_users.resolve(usernames)
+    except requests.exceptions.RequestException:
+        return MATTERMOST_UNAVAILABLE()
+
+    users, conflicts = find_users(mattermost_ids)
+    lines = []
+    for username in usernames:
+        if username not in mattermost_ids:
+            lines.append(f"User '{username}' does not seem to exist in Mattermost")
+            continue
+        if username in conflicts:
+            lines.append(
+                f"'{username}' belongs to a different Mattermost account in our database, ask a sysadmin"
             )
-        )
-        return mattermost_response(response, ephemeral=True)
-    if len(tokens) > 2:
-        return mattermost_response(
-            "To authorize a user: /authorize username [admin]\nTo list authorized users: /authorize",
-            ephemeral=True,
-        )
-    to_authorize_username = get_actual_username(tokens[0])
-    to_authorize_id = get_mattermost_id(to_authorize_username)
-    if to_authorize_id is None:
-        return mattermost_response(
-            "User '{}' does not seem to exist in Mattermost".format(
-                to_authorize_username
-            ),
-            ephemeral=True,
-        )
-    as_admin = len(tokens) == 2 and tokens[1] == "admin"
-    user = models.User.find_by_mm_id(to_authorize_id)
-    if not user:
-        user = models.User(to_authorize_username)
-        user.mattermost_id = to_authorize_id
-    user.authorized = True
-    user.admin = as_admin or user.admin
-    user.save()
-    if user.admin:
-        return mattermost_response("'{}' is now an admin".format(to_authorize_username))
-    else:
-        return mattermost_response(
-            "'{}' is now a regular user".format(to_authorize_username)
-        )
+            continue
+        user = users.get(username)
+        if not user:
+            user = users[username] = models.User(username)
+        user.mattermost_id = mattermost_ids[username]
+        user.authorized = True
+        user.admin = as_admin or user.admin
+        user.save()
+        if user.admin:
+            lines.append("'{}' is now an admin".format(username))
+        else:
+            lines.append("'{}' is now a regular user".format(username))
+    return mattermost_response("\n".join(lines))
 
 
 @door_access_blueprint.route("/revoke", methods=["POST"])
 @requires_token("revoke")
 @requires_admin
 def revoke(admin_username):
-    """Slash-command to revoke a user"""
+    """Slash-command to revoke users"""
 
     tokens = request.values.get("text").strip().split()
-    to_revoke_username = get_actual_username(tokens[0])
-    to_revoke_id = get_mattermost_id(to_revoke_username)
-    if to_revoke_id is None:
-        return mattermost_response(
-            "Could not find '{}' in Mattermost".format(to_revoke_username)
-        )
-    user = models.User.query.filter_by(mattermost_id=to_revoke_id).first()
-    if user is None:
-        return mattermost_response(
-            "Could not find '{}' in our database".format(to_revoke_username)
-        )
-    if user.admin:
-        return mattermost_response("Can't revoke admin user")
-    user.authorized = False
-    user.save()
+    if not tokens:
+        return REVOKE_USAGE()
+    usernames = [get_actual_username(token).lower() for token in tokens]
+    try:
+        mattermost_ids = mattermost_users.resolve(usernames)
+    except requests.exceptions.RequestException:
+        return MATTERMOST_UNAVAILABLE()
 
-    return mattermost_response("'{}' revoked".format(to_revoke_username))
+    users, conflicts = find_users(mattermost_ids)
+    lines = []
+    for username in usernames:
+        user = users.get(username)
+        if username not in mattermost_ids:
+            lines.append("Could not find '{}' in Mattermost".format(username))
+        elif username in conflicts:
+            lines.append(
+                "'{}' belongs to a different Mattermost account in our database".format(
+                    username
+                )
+            )
+        elif user is None:
+            lines.append("Could not find '{}' in our database".format(username))
+        elif user.admin:
+            lines.append("Can't revoke admin user '{}'".format(username))
+        else:
+            user.authorized = False
+            user.save()
+            lines.append("'{}' revoked".format(username))
+    return mattermost_response("\n".join(lines))
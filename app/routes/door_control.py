@@ -1,7 +1,15 @@
-from flask import Blueprint, abort, jsonify, request
+from flask import Blueprint, Response, abort, jsonify, request
+import json
+import threading
+import time
 
 from app import models
+from app.broadcast import door_status_broadcaster
+from app.doors import doors, get_door
 from app.util import (
+    StaticResponse,
+    cached_door_status,
+    door_statuses,
     lockbot_request,
     mattermost_doorkeeper_message,
     mattermost_response,
@@ -12,6 +20,23 @@ from app.util import (
 
 door_control_blueprint = Blueprint("door_control", __name__)
 
+DOOR_USAGE = StaticResponse(
+    "Only [open|lock|status|getkey] subcommands supported, optionally followed by the name of a door (or 'all' for status)",
+    ephemeral=True,
+)
+
+# Send a comment frame this often, so proxies don't close idle streams
+SSE_HEARTBEAT_SECONDS = 15
+# Seconds between looks at the shared cache, for changes seen by other workers.
+# Shorter than the status cache TTL, so no change expires before a stream sees it.
+SSE_POLL_SECONDS = 2
+# Every stream holds a thread, so a worker serves only this many at the same time
+SSE_MAX_STREAMS = 16
+# Seconds after which a stream is ended, the browser reconnects to any worker
+SSE_MAX_STREAM_SECONDS = 600
+
+_stream_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
 
 @door_control_blueprint.route("/door", methods=["POST"])
 @requires_token("door")
@@ -29,13 +54,24 @@ def door(user):
     if command == "close":
         command = "lock"
     if command not in ("open", "lock", "status"):
+        return DOOR_USAGE()
+    door_name = tokens[1].lower() if len(tokens) > 1 else None
+    if command == "status" and door_name == "all":
         return mattermost_response(
-            "Only [open|lock|status|getkey] subcommands supported", ephemeral=True
+            "\n".join(f"{name}: {status}" for name, status in door_statuses().items()),
+            ephemeral=True,
         )
-    translated_state_before_command = lockbot_request(command)
+    door = get_door(door_name)
+    if door is None:
+        return mattermost_response(
+            f"Unknown door '{door_name}', doors are: {', '.join(doors())}",
+            ephemeral=True,
+        )
+    translated_state_before_command = lockbot_request(command, door=door)
     if command != "status":
+        target = "door" if door_name is None else f"door '{door.name}'"
         mattermost_doorkeeper_message(
-            f"door was {translated_state_before_command}, {user.username} tried to {command} door"
+            f"{target} was {translated_state_before_command}, {user.username} tried to {command} {target}"
         )
     return mattermost_response(translated_state_before_command, ephemeral=True)
 
@@ -49,9 +85,69 @@ def doorapi(doorkey, command):
         return abort(401)
     if command not in ("open", "lock", "status"):
         return abort(400, "Command not in (open,lock,status)")
-    translated_state_before_command = lockbot_request(command)
+    door = get_door(request.values.get("door"))
+    if door is None:
+        return abort(404, "Unknown door")
+    translated_state_before_command = lockbot_request(command, door=door)
     if command != "status":
+        target = "door" if "door" not in request.values else f"door '{door.name}'"
         mattermost_doorkeeper_message(
-            f"door was {translated_state_before_command}, {user.username} tried to {command} door via the API"
+            f"{target} was {translated_state_before_command}, {user.username} tried to {command} {target} via the API"
         )
     return jsonify({"status": "ok", "before": translated_state_before_command})
+
+
+def door_status_event(status: str) -> str:
+    """Format a door status as a Server-Sent Event"""
+
+    return f"event: status\ndata: {json.dumps({'status': status})}\n\n"
+
+
+@door_control_blueprint.route("/api/door/stream", methods=["GET"])
+def door_stream():
+    """
+    Server-Sent Events stream of the door status
+
+    State callbacks handled by this worker are pushed right away, the ones handled
+    by other workers are picked up from the shared cache within `SSE_POLL_SECONDS`.
+    """
+
+    door = get_door(request.args.get("door"))
+    if door is None:
+        return abort(404)
+    if not _stream_slots.acquire(blocking=False):
+        return abort(503, "Too many door status streams")
+    try:
+        broadcaster = door_status_broadcaster(door.name)
+        initial_status = broadcaster.value or lockbot_request(
+            "status", use_cache=True, door=door
+        )
+    except Exception:
+        _stream_slots.release()
+        raise
+
+    def events():
+        status = initial_status
+        yield f"retry: {SSE_HEARTBEAT_SECONDS * 1000}\n\n"
+        yield door_status_event(status)
+        started = last_sent = time.monotonic()
+        for published in broadcaster.subscribe(SSE_POLL_SECONDS):
+            latest = published or cached_door_status(door.name) or status
+            now = time.monotonic()
+            if latest != status:
+                status = latest
+                yield door_status_event(status)
+                last_sent = now
+            elif now - last_sent >= SSE_HEARTBEAT_SECONDS:
+                yield ": heartbeat\n\n"
+                last_sent = now
+            if now - started >= SSE_MAX_STREAM_SECONDS:
+                return
+
+    response = Response(events(), mimetype="text/event-stream")
+    # Also called when the client went away before the stream started
+    response.call_on_close(_stream_slots.release)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return response
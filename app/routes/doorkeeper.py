@@ -1,59 +1,45 @@
 from flask import Blueprint, abort, request
 import hashlib
 import hmac
-import requests
-import sys
-import traceback
-from datetime import datetime, timedelta
+import logging
 
 
 from app.app import DOOR_STATUS
+from app.broadcast import door_status_broadcaster
+from app.cron import run_soon
+from app.doors import get_door
+from app.outbox import KELDERAPI, queue_event
 from app.util import (
+    cache_door_status,
     mattermost_doorkeeper_message,
     mark_door_electronically_used,
     in_electronic_action_period,
-    get_persistent_kv
 )
 
 import config
 
-KV_KEY_KELDERAPI_LAST_ERROR_MESSAGE = "kelderapi_last_error_message"
-KV_KEY_KELDERAPI_ERROR_COUNT = "kelderapi_error_count"
-
 doorkeeper_blueprint = Blueprint("doorkeeper", __name__)
 
+logger = logging.getLogger("mattermore.doorkeeper")
 
-def post_ratelimited_kelderapi_error(message):
-    '''Post error message to verbose-mattermost channel. Only posts one message every 5 minutes'''
-    last_posted_error_timestring = get_persistent_kv(KV_KEY_KELDERAPI_LAST_ERROR_MESSAGE, "0")
-    last_posted_error_datetime = datetime.fromtimestamp(float(last_posted_error_timestring.value))
-    error_count = get_persistent_kv(KV_KEY_KELDERAPI_ERROR_COUNT, "0")
-    if datetime.now() - last_posted_error_datetime > timedelta(hours=1):
-        last_posted_error_timestring.value = str(datetime.now().timestamp())
-        last_posted_error_timestring.save()
-        if int(error_count.value):
-            message += f"\n and {error_count.value} error message(s) not posted to this channel"
-        mattermost_doorkeeper_message(
-            message,
-            webhook=config.debug_webhook,
-        )
-        error_count.value = "0"
-        error_count.save()
-    else:
-        error_count.value = str(int(error_count.value) + 1)
-        error_count.save()
 
-
-@doorkeeper_blueprint.route("/doorkeeper", methods=["POST"])
-def doorkeeper():
+@doorkeeper_blueprint.route("/doorkeeper", methods=["POST"], defaults={"name": None})
+@doorkeeper_blueprint.route("/doorkeeper/<name>", methods=["POST"])
+def doorkeeper(name):
+    door = get_door(name)
+    if door is None:
+        return abort(404)
     raw_data = request.get_data()
     hmac_header = bytearray.fromhex(request.headers.get("HMAC"))
     calculated_hash = hmac.new(
-        config.up_key.encode("utf8"), raw_data, hashlib.sha256
+        door.up_key.encode("utf8"), raw_data, hashlib.sha256
     ).digest()
     if hmac_header != calculated_hash:
-        print(f"WRONG: {hmac_header} != {calculated_hash}", file=sys.stderr)
+        logger.warning(
+            "invalid HMAC", extra={"door": door.name, "received": hmac_header.hex()}
+        )
         return abort(401)
+    is_default_door = door.name == config.default_door
 
     data_dict = {
         l.split("=")[0]: l.split("=")[1] for l in raw_data.decode("utf8").split("&")
@@ -61,26 +47,10 @@ def doorkeeper():
     cmd = data_dict["cmd"]
     reason = data_dict["why"]
     value = data_dict["val"]
-    try:
-        r = requests.post(
-            config.kelderapi_doorkeeper_url,
-            json=data_dict,
-            headers={"Token": config.kelderapi_doorkeeper_key},
-            timeout=10,
-        )
-        r.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        post_ratelimited_kelderapi_error(
-            f"Kelderapi returned HTTP {r.status_code} after posting `{data_dict}`\n```\n{e.__class__.__name__}: {e}\n\n{r.text}```",
-        )
-    except requests.exceptions.RequestException as e:
-        post_ratelimited_kelderapi_error(
-            f"Posting `{data_dict}` to kelderapi failed\n```\n{e.__class__.__name__}: {e}\n```",
-        )
-    except:
-        post_ratelimited_kelderapi_error(
-            f"Posting `{data_dict}` to kelderapi failed\n```\n{traceback.format_exc()}\n```",
-        )
+    if is_default_door:
+        # Forwarded in the background, so lockbot never waits for kelderapi
+        queue_event(KELDERAPI, data_dict)
+        run_soon("kelderapi_outbox_task")
     if reason == "mattermore":
         if cmd == "status":
             return ""
@@ -91,18 +61,24 @@ def doorkeeper():
         msg = f"@sysadmin: the door panicked with reason {cmd}"
     elif reason == "state":
         msg = f"The door is now {DOOR_STATUS[value]}"
-        if not in_electronic_action_period():
+        # Streams on other workers pick the new status up from the shared cache
+        cache_door_status(door.name, DOOR_STATUS[value])
+        door_status_broadcaster(door.name).publish(DOOR_STATUS[value])
+        if not in_electronic_action_period(door):
+            door_name = "door" if is_default_door else f"door '{door.name}'"
             mattermost_doorkeeper_message(
-                f"@bestuur: door manually went to {DOOR_STATUS[value]} state"
+                f"@bestuur: {door_name} manually went to {DOOR_STATUS[value]} state"
             )
     elif reason == "chal":
         return ""
     elif reason == "delaybutton":
         msg = "Door locking started"
-        mark_door_electronically_used()
+        mark_door_electronically_used(door)
     elif reason == "locking":
         msg = "Delayed door close button was pressed"
     else:
         msg = f"Unhandled message type: {cmd},{reason},{value}"
+    if not is_default_door:
+        msg = f"[{door.name}] {msg}"
     mattermost_doorkeeper_message(msg, webhook=config.debug_webhook)
     return "OK"
@@ -4,11 +4,16 @@ from typing import Any
 from flask import Blueprint, Response, request
 import hashlib
 import hmac
+import logging
 import requests
 import time
 
-from app import models
+from app import log, models
+from app.devices import device_gateway
+from app.error_reporter import error_reporter
+from app.jobs import job_runner
 from app.util import (
+    StaticResponse,
     lockbot_request,
     mattermost_doorkeeper_message,
     mattermost_response,
@@ -21,22 +26,72 @@ import config
 
 fingerprint_blueprint = Blueprint("fingerprint", __name__)
 
+logger = logging.getLogger("mattermore.fingerprint")
+# Every use of the sensor is a detection, only keep a sample of those
+detected_logger = log.sampled_logger(
+    "mattermore.fingerprint.detected", config.log_detected_sample_rate
+)
+
+# Seconds in which the same sensor alert is only posted once
+SENSOR_ALERT_WINDOW = 300
+# Number of fingerprints the sensor can store
+FINGERPRINT_SLOTS = 200
+# Seconds to wait for the sensor, other workers wait for the device lock meanwhile
+FINGERPRINT_TIMEOUT = 3
+
+# Free slots on the sensor, as of the last time it was asked
+fingerprint_slots = {"total": FINGERPRINT_SLOTS, "free": None, "checked_at": None}
+
+SENSOR_ALERTS = {
+    "missing_hmac": "@sysadmin Fingerprint sensor received message without HMAC signature",
+    "too_long": "@sysadmin Fingerprint sensor received message longer than 128 bytes",
+    "invalid_hmac": "@sysadmin Fingerprint sensor received message with invalid HMAC signature",
+    "replay": "@sysadmin Fingerprint sensor received message with incorrect timestamp (possible replay attack)",
+}
+
+FINGERPRINT_USAGE = StaticResponse(
+    "Only [enroll|delete|list] subcommands supported", ephemeral=True
+)
+ENROLL_USAGE = StaticResponse(
+    "Missing or invalid fingerprint note, syntax: /fingerprint enroll \{note\}\n\{note\} must not contain spaces",
+    ephemeral=True,
+)
+DELETE_USAGE = StaticResponse(
+    "Missing or invalid fingerprint note, syntax: /fingerprint delete \{note\}\n\{note\} must not contain spaces",
+    ephemeral=True,
+)
+NO_FINGERPRINTS = StaticResponse("No fingerprints found", ephemeral=True)
+ENROLL_STARTED = StaticResponse(
+    "Preparing the fingerprint sensor, hang on…", ephemeral=True
+)
+
 
 def fingerprint_request(command: str, data: Any = None) -> "requests.Response":
     """
     Send a command to the fingerprint sensor, returns the sensors response
     """
 
-    timestamp = int(time.time() * 1000)
-    payload = f"{timestamp};{command};{data};" if data else f"{timestamp};{command};"
-    calculated_hmac = (
-        hmac.new(config.down_key.encode("utf8"), payload.encode("utf8"), hashlib.sha256)
-        .hexdigest()
-        .upper()
-    )
-    return requests.post(
-        config.fingerprint_url, payload, headers={"HMAC": calculated_hmac}
-    )
+    def send() -> "requests.Response":
+        timestamp = int(time.time() * 1000)
+        payload = (
+            f"{timestamp};{command};{data};" if data else f"{timestamp};{command};"
+        )
+        calculated_hmac = (
+            hmac.new(
+                config.down_key.encode("utf8"), payload.encode("utf8"), hashlib.sha256
+            )
+            .hexdigest()
+            .upper()
+        )
+        with log.upstream_call("fingerprint", command):
+            return requests.post(
+                config.fingerprint_url,
+                payload,
+                headers={"HMAC": calculated_hmac, **log.request_id_headers()},
+                timeout=FINGERPRINT_TIMEOUT,
+            )
+
+    return device_gateway("fingerprint").run(command, send)
 
 
 def get_free_fp_ids() -> set[int]:
@@ -50,8 +105,10 @@ def get_free_fp_ids() -> set[int]:
         if val == "1":
             used_ids.add(i)
 
-    all_ids = set(range(1, 201))
-    return all_ids.difference(used_ids)
+    all_ids = set(range(1, FINGERPRINT_SLOTS + 1))
+    free_ids = all_ids.difference(used_ids)
+    fingerprint_slots.update(free=len(free_ids), checked_at=time.time())
+    return free_ids
 
 
 def pretty_user_fingerprints(d: dict[str, list[str]]) -> str:
@@ -74,6 +131,29 @@ def send_fingerprint_delete(ids: list[int]):
         fingerprint_request("delete", id_)
 
 
+def enroll_fingerprint(user_id: int, username: str, fp_note: str) -> str:
+    """Put the sensor in enroll mode for a new fingerprint, returns the reply to the user"""
+
+    # Ensure that no pending fingerprints remain (this only rarely do something)
+    deleted_ids = models.Fingerprint.clear_inactive()
+    send_fingerprint_delete(deleted_ids)
+
+    ids = get_free_fp_ids()
+    if len(ids) == 0:
+        return "Cannot enroll fingerprint, no free slots left"
+
+    fp_id = min(ids)
+    fingerprint_request("enroll", fp_id)
+
+    models.Fingerprint.create(fp_id, user_id, fp_note, datetime.now())
+
+    logger.info(
+        "created inactive fingerprint",
+        extra={"fingerprint_id": fp_id, "username": username, "note": fp_note},
+    )
+    return f"Started enrolling fingerprint #{fp_id} for user '{username}'"
+
+
 @fingerprint_blueprint.route("/fingerprint", methods=["POST"])
 @requires_token("fingerprint")
 @requires_regular
@@ -82,9 +162,7 @@ def fingerprint(user):
     try:
         command = tokens[0].lower()
     except IndexError:
-        return mattermost_response(
-            "Only [enroll|delete|list] subcommands supported", ephemeral=True
-        )
+        return FINGERPRINT_USAGE()
 
     user_id = (
         models.User.query.filter(models.User.username == user.username)
@@ -96,42 +174,25 @@ def fingerprint(user):
         try:
             fp_note = tokens[1].lower()
         except IndexError:
-            return mattermost_response(
-                "Missing or invalid fingerprint note, syntax: /fingerprint enroll \{note\}\n\{note\} must not contain spaces",
-                ephemeral=True,
-            )
-
-        # Ensure that no pending fingerprints remain (this only rarely do something)
-        deleted_ids = models.Fingerprint.clear_inactive()
-        send_fingerprint_delete(deleted_ids)
-
-        ids = get_free_fp_ids()
-        if len(ids) == 0:
-            return mattermost_response(
-                "Cannot enroll fingerprint, no free slots left", ephemeral=True
-            )
-
-        fp_id = min(ids)
-        fingerprint_request("enroll", fp_id)
-
-        models.Fingerprint.create(fp_id, user_id, fp_note, datetime.now())
-
-        print(
-            f"created inactive fingerprint {fp_id} for user {user.username} with note {fp_note}"
-        )
-        return mattermost_response(
-            f"Started enrolling fingerprint #{fp_id} for user '{user.username}'",
-            ephemeral=True,
+            return ENROLL_USAGE()
+
+        # Talking to the sensor can take longer than Mattermost waits for a reply
+        job_runner.submit(
+            "fingerprint enroll",
+            enroll_fingerprint,
+            user_id,
+            user.username,
+            fp_note,
+            device="fingerprint",
+            response_url=request.values.get("response_url"),
         )
+        return ENROLL_STARTED()
 
     if command == "delete":
         try:
             fp_note = tokens[1].lower()
         except IndexError:
-            return mattermost_response(
-                "Missing or invalid fingerprint note, syntax: /fingerprint delete \{note\}\n\{note\} must not contain spaces",
-                ephemeral=True,
-            )
+            return DELETE_USAGE()
 
         fingerprint = None
         username = user.username
@@ -158,7 +219,10 @@ def fingerprint(user):
 
         fingerprint_request("delete", fingerprint.id)
 
-        print(f"sent command delete fingerprint {fp_note} for {username}")
+        logger.info(
+            "sent command to delete fingerprint",
+            extra={"fingerprint_id": fingerprint.id, "username": username},
+        )
         return mattermost_response(
             f"Deleted fingerprint '{fp_note}' for user '{username}'",
             ephemeral=True,
@@ -179,16 +243,14 @@ def fingerprint(user):
             return mattermost_response(msg, ephemeral=True)
 
         if len(user_fingerprints) == 0:
-            return mattermost_response("No fingerprints found", ephemeral=True)
+            return NO_FINGERPRINTS()
 
         return mattermost_response(
             pretty_user_fingerprints(user_fingerprints), ephemeral=True
         )
 
     if command not in ("enroll", "delete", "list"):
-        return mattermost_response(
-            "Only [enroll|delete|list] subcommands supported", ephemeral=True
-        )
+        return FINGERPRINT_USAGE()
 
     return mattermost_response("")
 
@@ -201,27 +263,34 @@ def fingerprint_cb():
         fingerprint = models.Fingerprint.find_by_id(int(val))
         fingerprint.active = True
         fingerprint.save()
-        print(f"[ACK] activated fingerprint {fingerprint.id} for {fingerprint.user_id}")
+        logger.info(
+            "activated fingerprint",
+            extra={"fingerprint_id": fingerprint.id, "user_id": fingerprint.user_id},
+        )
         mattermost_doorkeeper_message(
             f"Activated fingerprint {fingerprint.note} for user {fingerprint.user.username}",
             webhook=config.debug_webhook,
         )
     elif msg == "detected":
         fingerprint = models.Fingerprint.find_active_by_id(int(val))
-        print(f"detected fingerprint {fingerprint.id}")
+        detected_logger.info(
+            "detected fingerprint", extra={"fingerprint_id": fingerprint.id}
+        )
         user = fingerprint.user
 
         if not user:
-            mattermost_doorkeeper_message(
+            error_reporter.report(
+                f"fingerprint_{fingerprint.id}_no_user",
                 f"@sysadmin Fingerprint sensor detected fingerprint (#{fingerprint.id}) for user that no longer exists",
-                webhook=config.debug_webhook,
+                window=SENSOR_ALERT_WINDOW,
             )
             return Response("", status=200)
 
         if not user.authorized:
-            mattermost_doorkeeper_message(
+            error_reporter.report(
+                f"fingerprint_{fingerprint.id}_unauthorized",
                 f"@sysadmin Fingerprint sensor detected fingerprint (#{fingerprint.id}) for unauthorized user ({user.username})",
-                webhook=config.debug_webhook,
+                window=SENSOR_ALERT_WINDOW,
             )
             return Response("", status=200)
 
@@ -243,36 +312,24 @@ def fingerprint_cb():
         user_id = fingerprint.user_id
 
         fingerprint.delete_()
-        print(f"[ACK] deleted fingerprint '{note}' for '{user_id}'")
+        logger.info(
+            "deleted fingerprint",
+            extra={"fingerprint_id": fingerprint.id, "user_id": user_id},
+        )
         mattermost_doorkeeper_message(
             f"Deleted fingerprint '{fingerprint.note}' for user '{user.username}'",
             webhook=config.debug_webhook,
         )
 
-    elif msg == "missing_hmac":
-        mattermost_doorkeeper_message(
-            "@sysadmin Fingerprint sensor received message without HMAC signature",
-            webhook=config.debug_webhook,
-        )
-    elif msg == "too_long":
-        mattermost_doorkeeper_message(
-            "@sysadmin Fingerprint sensor received message longer than 128 bytes",
-            webhook=config.debug_webhook,
-        )
-    elif msg == "invalid_hmac":
-        mattermost_doorkeeper_message(
-            "@sysadmin Fingerprint sensor received message with invalid HMAC signature",
-            webhook=config.debug_webhook,
-        )
-    elif msg == "replay":
-        mattermost_doorkeeper_message(
-            "@sysadmin Fingerprint sensor received message with incorrect timestamp (possible replay attack)",
-            webhook=config.debug_webhook,
+    elif msg in SENSOR_ALERTS:
+        error_reporter.report(
+            f"fingerprint_{msg}", SENSOR_ALERTS[msg], window=SENSOR_ALERT_WINDOW
         )
     else:
-        mattermost_doorkeeper_message(
+        error_reporter.report(
+            "fingerprint_invalid_callback",
             "@sysadmin Received invalid fingerprint callback message",
-            webhook=config.debug_webhook,
+            window=SENSOR_ALERT_WINDOW,
         )
 
     return Response("", status=200)
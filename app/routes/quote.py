@@ -1,7 +1,7 @@
 from flask import Blueprint, request
-import random
 
 from app import models
+from app.quote_sampler import quote_sampler
 from app.util import mattermost_response, requires_token
 
 quote_blueprint = Blueprint("quote", __name__)
@@ -13,8 +13,9 @@ def add_quote():
     user = request.values["user_name"]
     channel = request.values["channel_name"]
     quote_text = request.values["text"]
-    quote = models.Quote(user, quote_text, channel)
+    quote = models.Quote.from_text(user, quote_text, channel)
     quote.save()
+    models.QuoteStat.count_quote(quote)
 
     return mattermost_response('{} added the quote "{}"'.format(user, quote_text))
 
@@ -22,11 +23,20 @@ def add_quote():
 @quote_blueprint.route("/quote", methods=["POST"])
 def random_quote():
     text_contains = request.values["text"]
-    matches = models.Quote.query.filter(
-        models.Quote.quote.contains(text_contains)
-    ).all()
-    if matches:
-        selected_quote = random.choice(matches)
+    channel = request.values.get("channel_name", "")
+    if not text_contains:
+        selected_quote = quote_sampler.random_quote(channel)
+    elif text_contains.startswith("@"):
+        # Quotes of a person, e.g. `/quote @jan`
+        selected_quote = quote_sampler.random_quote_of(
+            models.Quote.of_person(text_contains[1:].strip()), channel
+        )
+    else:
+        selected_quote = quote_sampler.random_quote_of(
+            models.Quote.query.filter(models.Quote.quote.contains(text_contains)),
+            channel,
+        )
+    if selected_quote is not None:
         response = selected_quote.quote
         return mattermost_response(response)
     return mattermost_response(
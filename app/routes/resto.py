@@ -1,9 +1,12 @@
-from datetime import datetime
+from datetime import date
 from flask import Blueprint
-import requests
+from operator import attrgetter
 
+from app.menu import Meal, Menu, get_menu
 from app.util import mattermost_response
 
+import config
+
 
 resto_blueprint = Blueprint("resto", __name__)
 
@@ -41,55 +44,59 @@ RESTO_TABLES = {
 }
 
 
-@resto_blueprint.route("/resto", methods=["GET"])
-def resto_menu():
-    today = datetime.today()
-    url = f"https://hydra.ugent.be/api/2.0/resto/menu/nl/{today.year}/{today.month}/{today.day}.json"
-    resto = requests.get(url, timeout=5).json()
+RECOGNIZED_KINDS = set.union(*RESTO_TABLES.values())
+
+
+def format_meals(meals: list[Meal], width: int, name=attrgetter("name")) -> str:
+    if not meals:
+        return "None :("
+    return "\n".join(
+        "{name: <{width}}{price}".format(
+            name=name(meal), width=width + 2, price=meal.price
+        )
+        for meal in meals
+    )
+
 
-    if not resto["open"]:
+def render_resto_menu(menu: Menu) -> str:
+    if not menu.open:
         return "De resto is vandaag gesloten."
-    else:
-
-        def table_for(kinds):
-            items = [meal for meal in resto["meals"] if meal["kind"] in kinds]
-            return format_items(items)
-
-        def format_items(items):
-            if not items:
-                return "None :("
-            maxwidth = max(len(item["name"]) for item in items)
-            return "\n".join(
-                "{name: <{width}}{price}".format(
-                    name=item["name"], width=maxwidth + 2, price=item["price"]
-                )
-                for item in items
-            )
 
-        recognized_kinds = set.union(*RESTO_TABLES.values())
-        uncategorized_meals = [
-            meal for meal in resto["meals"] if meal["kind"] not in recognized_kinds
-        ]
-
-        uncategorized = (
-            ""
-            if not uncategorized_meals
-            else UNCATEGORIZED_TEMPLATE.format(
-                format_items(
-                    [
-                        # Small hack: change "name" into "name (kind)"
-                        {**meal, "name": "{} ({})".format(meal["name"], meal["kind"])}
-                        for meal in uncategorized_meals
-                    ]
-                )
+    uncategorized_kinds = [
+        kind for kind in menu.by_kind if kind not in RECOGNIZED_KINDS
+    ]
+    uncategorized = (
+        ""
+        if not uncategorized_kinds
+        else UNCATEGORIZED_TEMPLATE.format(
+            format_meals(
+                menu.of_kinds(uncategorized_kinds),
+                # Names are rendered as "name (kind)"
+                max(
+                    menu.name_widths[kind] + len(kind) + 3
+                    for kind in uncategorized_kinds
+                ),
+                name=lambda meal: "{} ({})".format(meal.name, meal.kind),
             )
         )
+    )
 
-        return RESTO_TEMPLATE.format(
-            **{k: table_for(v) for k, v in RESTO_TABLES.items()},
-            uncategorized=uncategorized,
-            vegetable_table="\n".join(resto["vegetables"]),
-        )
+    return RESTO_TEMPLATE.format(
+        **{
+            table: format_meals(menu.of_kinds(kinds), menu.name_width(kinds))
+            for table, kinds in RESTO_TABLES.items()
+        },
+        uncategorized=uncategorized,
+        vegetable_table="\n".join(menu.vegetables),
+    )
+
+
+@resto_blueprint.route("/resto", methods=["GET"])
+def resto_menu():
+    menu = get_menu(config.resto_endpoints[0], date.today())
+    if menu is None:
+        return "Het menu van vandaag is niet beschikbaar."
+    return render_resto_menu(menu)
 
 
 @resto_blueprint.route("/resto.json", methods=["GET"])
@@ -1,6 +1,8 @@
 from flask import Blueprint, jsonify
 
-from app.util import lockbot_request
+from app.util import door_statuses
+
+import config
 
 
 spaceapi_blueprint = Blueprint("spaceapi", __name__)
@@ -28,13 +30,21 @@ def spaceapi():
         },
         "projects": ["https://github.com/zeuswpi", "https://git.zeus.gent"],
     }
-    door_status = lockbot_request("status", use_cache=True)
+    statuses = door_statuses()
+    door_status = statuses[config.default_door]
     if door_status == "open":
         data["state"]["open"] = True
     elif door_status == "locked":
         data["state"]["open"] = False
     # Else, don't put the 'open' property in the response, to indicate temporary unavailability
     #  per https://spaceapi.io/docs/#schema-key-state
+    data["sensors"] = {
+        "door_locked": [
+            {"value": status == "locked", "location": name}
+            for name, status in statuses.items()
+            if status in ("open", "locked")
+        ]
+    }
     response = jsonify(data)
     response.headers.add("Access-Control-Allow-Origin", "*")
     return response
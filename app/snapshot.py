@@ -0,0 +1,94 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Optional
+
+import config
+
+logger = logging.getLogger("mattermore.snapshot")
+
+
+class SnapshotRegistry:
+    """
+    Keep in-process caches warm across worker restarts
+
+    Caches register a function that dumps their contents to something JSON
+    serializable, and one that loads such a dump. Dumps are written to a single file
+    on exit and periodically, a cache is loaded from it as soon as it registers. A
+    dump older than `max_age` seconds is ignored, caches check the age of their own
+    entries when loading.
+    """
+
+    def __init__(self, path: str, max_age: float):
+        self.path = path
+        self.max_age = max_age
+        self._caches: dict[str, tuple[Callable[[], Any], Callable[[Any], None]]] = {}
+        self._snapshot: Optional[dict] = None
+        self._lock = threading.Lock()
+
+    def _read(self) -> dict[str, dict]:
+        """The dumps in the snapshot file that aren't too old, by cache name"""
+
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        oldest = time.time() - self.max_age
+        return {
+            name: dump
+            for name, dump in snapshot.items()
+            if dump.get("saved_at", 0) >= oldest
+        }
+
+    def register(self, name: str, dump: Callable[[], Any], load: Callable[[Any], None]):
+        """
+        Snapshot a cache from now on, and load it from the last snapshot
+
+        `dump` returns `None` when the cache has nothing worth keeping.
+        """
+
+        with self._lock:
+            self._caches[name] = (dump, load)
+            if self._snapshot is None:
+                self._snapshot = self._read()
+            saved = self._snapshot.get(name)
+        if saved is not None:
+            try:
+                load(saved["data"])
+            except Exception:
+                logger.exception("loading cache snapshot failed", extra={"cache": name})
+
+    def save(self):
+        """
+        Write the caches to the snapshot file
+
+        Caches without anything to dump keep what an earlier snapshot had, so e.g. a
+        short-lived CLI command doesn't wipe the snapshot of a warm worker.
+        """
+
+        with self._lock:
+            caches = self._read()
+            for name, (dump, load) in self._caches.items():
+                try:
+                    data = dump()
+                except Exception:
+                    logger.exception(
+                        "dumping cache snapshot failed", extra={"cache": name}
+                    )
+                    continue
+                if data is not None:
+                    caches[name] = {"saved_at": time.time(), "data": data}
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # Write to a temporary file first, so workers never read half a snapshot
+            temporary_path = f"{self.path}.{os.getpid()}"
+            with open(temporary_path, "w") as f:
+                json.dump(caches, f)
+            os.replace(temporary_path, self.path)
+
+
+snapshots = SnapshotRegistry(config.cache_snapshot_path, config.cache_snapshot_max_age)
+atexit.register(snapshots.save)
@@ -0,0 +1,91 @@
+import logging
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+from app import models
+from app.app import mm_driver
+from app.error_reporter import error_reporter
+from app.mattermost_users import mattermost_users
+from app.util import (
+    get_persistent_value,
+    mattermost_doorkeeper_message,
+    set_persistent_value,
+)
+
+import config
+
+KV_KEY_USER_SYNC_SINCE = "mattermost_user_sync_since"
+# Number of users asked to Mattermost per request
+USER_SYNC_PAGE_SIZE = 100
+# Milliseconds the next sync looks back before the start of this one, so users that
+# changed while we were syncing aren't missed
+USER_SYNC_OVERLAP_MS = 60 * 1000
+
+logger = logging.getLogger("mattermore.user_sync")
+
+
+def sync_mattermost_users() -> tuple[int, int]:
+    """
+    Update our users with the changes to their Mattermost accounts since the last sync
+
+    Renamed users get their new username, users whose account was deactivated lose
+    access to the door. Revocations are committed right away. A rename that
+    conflicts with another user is reported and skipped, the other renames still go
+    through. Returns the number of renamed and revoked users.
+    """
+
+    started_at = int(time.time() * 1000)
+    since = int(get_persistent_value(KV_KEY_USER_SYNC_SINCE, "0"))
+    users = {
+        user.mattermost_id: user
+        for user in models.User.query.filter(models.User.mattermost_id.isnot(None))
+    }
+    mattermost_ids = sorted(users)
+
+    renamed = []
+    revoked = []
+    for start in range(0, len(mattermost_ids), USER_SYNC_PAGE_SIZE):
+        page = mattermost_ids[start : start + USER_SYNC_PAGE_SIZE]
+        for account in mm_driver.client.post(
+            "/users/ids", options=page, params={"since": since}
+        ):
+            user = users[account["id"]]
+            if account.get("delete_at"):
+                mattermost_users.forget(account["id"])
+                if user.authorized:
+                    user.authorized = False
+                    # Don't let a later failure keep the door open for them
+                    user.save(immediately=True)
+                    revoked.append(user.username)
+                continue
+            mattermost_users.remember(account["id"], account["username"])
+            if user.username == account["username"]:
+                continue
+            rename = f"{user.username} -> {account['username']}"
+            try:
+                with models.db.session.begin_nested():
+                    user.username = account["username"]
+            except IntegrityError:
+                # e.g. a user took the old username of another user that wasn't
+                # synced yet, the next change to either account fixes it
+                error_reporter.report(
+                    f"user_sync_{account['id']}",
+                    f"Syncing Mattermost users couldn't rename {rename}, the username is taken",
+                )
+                continue
+            renamed.append(rename)
+
+    set_persistent_value(KV_KEY_USER_SYNC_SINCE, str(started_at - USER_SYNC_OVERLAP_MS))
+
+    if renamed or revoked:
+        logger.info(
+            "synced Mattermost users", extra={"renamed": renamed, "revoked": revoked}
+        )
+    if revoked:
+        mattermost_doorkeeper_message(
+            "Revoked door access of deactivated Mattermost users: "
+            + ", ".join(revoked),
+            webhook=config.debug_webhook,
+        )
+    return len(renamed), len(revoked)
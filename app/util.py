@@ -1,50 +1,52 @@
-from flask import Response, abort, request
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import Response, abort, redirect, request
 from functools import wraps
 import hashlib
 import hmac
+from itsdangerous import BadSignature, URLSafeTimedSerializer
 import json
 import requests
 import time
-from typing import Union
+from typing import Optional, Union
 
-from app import models
-from app.app import DOOR_STATUS, mm_driver
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from app import doors, log, models
+from app.app import DOOR_STATUS
+from app.cache import shared_cache
+from app.devices import device_gateway
 
 import config
 
 
-KV_KEY_LAST_OPERATED_ELECTRONICALLY = "doorkeeper_last_electronic"
-KV_KEY_LAST_STATUS_UPDATE = "doorkeeper_last_status_update"
+CACHE_KEY_LAST_OPERATED_ELECTRONICALLY = "doorkeeper_last_electronic"
+CACHE_KEY_LAST_STATUS_UPDATE = "doorkeeper_last_status_update"
 
+# Seconds after the last electronic action (delayed close is 10 seconds)
+ELECTRONIC_ACTION_PERIOD = 12
+# Seconds a cached door status is used
+STATUS_CACHE_TTL = 10
+# Seconds a KeyValue entry is served from the shared cache
+KV_CACHE_TTL = 3600
+# Seconds a browser stays logged in to a page that requires a bearer token
+TOKEN_COOKIE_MAX_AGE = 12 * 3600
+# Seconds all doors together may take to answer a status request
+DOOR_STATUSES_TIMEOUT = 4
 
-def get_mattermost_id(username: str) -> Union[str, None]:
-    """
-    Given a mattermost username, return the user id.
+_door_status_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="door")
 
-    Returns `None` if no user with the given username exists
 
-    Don't call this with stale data
+def query_user() -> Optional["models.User"]:
     """
+    The user that sent this slash command. Only use in requests.
 
-    try:
-        response = mm_driver.users.get_user_by_username(username)
-        return response["id"]
-    except:
-        return None
-
-
-def query_and_update_username() -> "models.User":
-    """Updates mattermost data if need be. Only use in requests."""
+    Renames are picked up by the user sync job, so this never writes.
+    """
 
-    mattermost_user_id = request.values.get("user_id")
-    username = request.values.get("user_name")
-    user = models.User.find_by_mm_id(mattermost_user_id)
-    if not user:
-        return None
-    if user.username != username:
-        user.username = username
-        user.save()
-    return user
+    return models.User.find_by_mm_id(request.values.get("user_id"))
 
 
 def requires_regular(f):
@@ -52,7 +54,7 @@ def requires_regular(f):
 
     @wraps(f)
     def decorated(*args, **kwargs):
-        user = query_and_update_username()
+        user = query_user()
         if not user or not user.authorized:
             return abort(401)
         return f(user, *args, **kwargs)
@@ -65,7 +67,7 @@ def requires_admin(f):
 
     @wraps(f)
     def decorated(*args, **kwargs):
-        user = query_and_update_username()
+        user = query_user()
         if not user or not user.authorized or not user.admin:
             return abort(401)
         return f(user, *args, **kwargs)
@@ -90,14 +92,106 @@ def requires_token(token_name: str):
     return decorator
 
 
+def requires_bearer_token(token_name: str, browser=False):
+    """
+    Decorator to require a correct token in the Authorization header
+
+    For endpoints that aren't slash commands, a token in the URL would end up in
+    access logs and Referer headers. Browsers can't send the header, so for pages
+    with `browser` set the token is accepted once in the `token` parameter, which
+    is exchanged for a signed HttpOnly cookie that only this page receives.
+    """
+
+    cookie_name = f"{token_name}_session"
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            token = config.tokens[token_name]
+            if hmac.compare_digest(
+                request.headers.get("Authorization", ""), f"Bearer {token}"
+            ):
+                return f(*args, **kwargs)
+            if not browser:
+                return abort(401)
+            # Signed with the token itself, so changing it logs every browser out
+            serializer = URLSafeTimedSerializer(token, salt=cookie_name)
+            try:
+                serializer.loads(
+                    request.cookies.get(cookie_name, ""),
+                    max_age=TOKEN_COOKIE_MAX_AGE,
+                )
+                return f(*args, **kwargs)
+            except BadSignature:
+                pass
+            if not hmac.compare_digest(request.args.get("token", ""), token):
+                return abort(401)
+            # Drop the token from the URL, so reloads don't send it again
+            response = redirect(request.path)
+            response.set_cookie(
+                cookie_name,
+                serializer.dumps(token_name),
+                max_age=TOKEN_COOKIE_MAX_AGE,
+                path=request.path,
+                secure=True,
+                httponly=True,
+                samesite="Strict",
+            )
+            return response
+
+        return decorated_function
+
+    return decorator
+
+
+def json_dumps(data) -> Union[str, bytes]:
+    """Serialize to JSON, with orjson if it's installed"""
+
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data)
+
+
+def mattermost_response_body(
+    message: str, ephemeral: bool = False
+) -> Union[str, bytes]:
+    """Serialize a reply to a slash command"""
+
+    return json_dumps(
+        {
+            "response_type": "ephemeral" if ephemeral else "in_channel",
+            "text": message,
+        }
+    )
+
+
 def mattermost_response(message: str, ephemeral: bool = False) -> Response:
     """Reply to a message in the same channel, optionally making the message ephemeral"""
 
-    response_dict = {
-        "response_type": "ephemeral" if ephemeral else "in_channel",
-        "text": message,
-    }
-    return Response(json.dumps(response_dict), mimetype="application/json")
+    return Response(
+        mattermost_response_body(message, ephemeral), mimetype="application/json"
+    )
+
+
+class StaticResponse:
+    """A `mattermost_response` that never changes, so it's serialized only once"""
+
+    def __init__(self, message: str, ephemeral: bool = False):
+        self.body = mattermost_response_body(message, ephemeral)
+
+    def __call__(self) -> Response:
+        return Response(self.body, mimetype="application/json")
+
+
+def post_delayed_response(response_url: str, message: str, ephemeral: bool = False):
+    """Reply to a slash command after its request was already answered"""
+
+    requests.post(
+        response_url,
+        data=mattermost_response_body(message, ephemeral),
+        headers={"Content-Type": "application/json"},
+        timeout=10,
+    ).raise_for_status()
 
 
 def mattermost_doorkeeper_message(
@@ -114,65 +208,136 @@ def get_actual_username(username: str) -> str:
     return username.lstrip("@")
 
 
-def get_persistent_kv(name: str, default: str):
-    return models.KeyValue.query.filter_by(keyname=name).first() or models.KeyValue(
-        name, default
+def get_persistent_value(name: str, default: str) -> str:
+    """Get a value from the KeyValue store, through the shared cache"""
+
+    value = shared_cache.get(f"kv:{name}")
+    if value is None:
+        kv = models.KeyValue.query.filter_by(keyname=name).first()
+        value = kv.value if kv is not None else default
+        shared_cache.set(f"kv:{name}", value, ttl=KV_CACHE_TTL)
+    return value
+
+
+def set_persistent_value(name: str, value: str):
+    """Store a value in the KeyValue store and the shared cache"""
+
+    kv = models.KeyValue.query.filter_by(keyname=name).first() or models.KeyValue(
+        name, value
+    )
+    kv.value = value
+    # Other workers mustn't see a value that might still be rolled back
+    models.on_commit(lambda: shared_cache.set(f"kv:{name}", value, ttl=KV_CACHE_TTL))
+    kv.save()
+
+
+def cached_door_status(door_name: str) -> Optional[str]:
+    """The last status of a door any worker saw, `None` if it expired"""
+
+    return shared_cache.get(f"{CACHE_KEY_LAST_STATUS_UPDATE}:{door_name}")
+
+
+def cache_door_status(door_name: str, status: str):
+    """Share the status of a door with all workers"""
+
+    shared_cache.set(
+        f"{CACHE_KEY_LAST_STATUS_UPDATE}:{door_name}", status, ttl=STATUS_CACHE_TTL
     )
 
 
-def mark_door_electronically_used():
+def mark_door_electronically_used(door: Optional[models.Door] = None):
     """Mark the door as operated electronically (fingerprint, slash-command, ...)"""
-    last_usage = get_persistent_kv(KV_KEY_LAST_OPERATED_ELECTRONICALLY, "0")
-    last_usage.value = str(time.time())
-    last_usage.save()
+    door = door or doors.default_door()
+    shared_cache.set(
+        f"{CACHE_KEY_LAST_OPERATED_ELECTRONICALLY}:{door.name}",
+        str(time.time()),
+        ttl=ELECTRONIC_ACTION_PERIOD,
+    )
 
 
-def in_electronic_action_period():
+def in_electronic_action_period(door: Optional[models.Door] = None):
     """Check if the door is in the 'electronic action period'
 
     This is a small period after every electronic action after which it's unlikely the door
     was manually interacted with.
     """
-    last_usage = get_persistent_kv(KV_KEY_LAST_OPERATED_ELECTRONICALLY, "0")
-    time_last_usage = float(last_usage.value)
-    # 12 seconds after last electronic action (delayed close is 10 seconds)
-    return time.time() < time_last_usage + 12
+    door = door or doors.default_door()
+    key = f"{CACHE_KEY_LAST_OPERATED_ELECTRONICALLY}:{door.name}"
+    return shared_cache.get(key) is not None
 
 
-def lockbot_request(command: str, use_cache=False) -> str:
+def lockbot_request(
+    command: str, use_cache=False, door: Optional[models.Door] = None
+) -> str:
     """
-    Send a command to lockbot, returns the status of the door after the request
-    was handled
+    Send a command to the lockbot of a door (the default door if none is given),
+    returns the status of the door after the request was handled
     """
 
-    # TODO: fix this function properly with a mutex
-
+    door = door or doors.default_door()
     # Cache status requests, so we don't overwhelm lockbot
     if use_cache and command == "status":
-        cache_timestamp_s, cache_value = get_persistent_kv(
-            KV_KEY_LAST_STATUS_UPDATE, "0,?"
-        ).value.split(",")
-        if float(cache_timestamp_s) + 10 > time.time():
+        cache_value = cached_door_status(door.name)
+        if cache_value is not None:
             return cache_value
-    timestamp = int(time.time() * 1000)
-    payload = f"{timestamp};{command}"
-    calculated_hmac = (
-        hmac.new(config.down_key.encode("utf8"), payload.encode("utf8"), hashlib.sha256)
-        .hexdigest()
-        .upper()
-    )
     if command != "status":
-        mark_door_electronically_used()
-    try:
-        r = requests.post(
-            config.lockbot_url, payload, headers={"HMAC": calculated_hmac},
-            timeout=3
+        mark_door_electronically_used(door)
+
+    def send() -> str:
+        timestamp = int(time.time() * 1000)
+        payload = f"{timestamp};{command}"
+        calculated_hmac = (
+            hmac.new(
+                door.down_key.encode("utf8"), payload.encode("utf8"), hashlib.sha256
+            )
+            .hexdigest()
+            .upper()
         )
-        result = DOOR_STATUS[r.text]
-    except requests.exceptions.RequestException as e:
-        # We also cache timeouts, to avoid the service hanging if lockbot/kelder gateway dies
-        result = "error"
-    cached_kv = get_persistent_kv(KV_KEY_LAST_STATUS_UPDATE, "0,?")
-    cached_kv.value = f"{time.time()},{result}"
-    cached_kv.save()
+        try:
+            with log.upstream_call(f"lockbot:{door.name}", command):
+                r = requests.post(
+                    door.url,
+                    payload,
+                    headers={"HMAC": calculated_hmac, **log.request_id_headers()},
+                    timeout=3,
+                )
+            return DOOR_STATUS[r.text]
+        except requests.exceptions.RequestException as e:
+            # We also cache timeouts, to avoid the service hanging if lockbot/kelder gateway dies
+            return "error"
+
+    # Status requests that waited for another worker's status request share its result
+    result = device_gateway(f"lockbot:{door.name}").run(
+        command, send, coalesce=command == "status"
+    )
+    cache_door_status(door.name, result)
     return result
+
+
+def door_statuses() -> dict[str, str]:
+    """
+    The status of every door, asked to all lockbots at the same time
+
+    Doors that didn't answer within `DOOR_STATUSES_TIMEOUT` seconds are "unknown".
+    """
+
+    request_id = log.current_request_id()
+
+    def status(door: models.Door) -> str:
+        with log.bind_request_id(request_id):
+            return lockbot_request("status", use_cache=True, door=door)
+
+    futures = {
+        name: _door_status_pool.submit(status, door)
+        for name, door in doors.doors().items()
+    }
+    wait(futures.values(), timeout=DOOR_STATUSES_TIMEOUT)
+    statuses = {}
+    for name, future in futures.items():
+        if not future.done():
+            statuses[name] = "unknown"
+        elif future.exception() is not None:
+            statuses[name] = "error"
+        else:
+            statuses[name] = future.result()
+    return statuses
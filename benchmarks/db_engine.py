@@ -0,0 +1,87 @@
+"""
+Compare write throughput of the database engine configurations
+
+Every mode runs the same workload: a number of threads that each do small
+read-then-write transactions on the KeyValue table, like concurrent slash commands
+and scheduler jobs do. Set BENCH_POSTGRES_URL to also benchmark a PostgreSQL server.
+"""
+
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from benchmarks.harness import BENCH_DIR
+from app import models
+
+THREADS = 8
+TRANSACTIONS_PER_THREAD = 200
+
+
+def run_workload(engine) -> tuple[float, int]:
+    """Run the workload, returns transactions per second and the number of failures"""
+
+    models.db.metadata.create_all(engine)
+    failures = 0
+    failures_lock = threading.Lock()
+
+    def worker(n):
+        nonlocal failures
+        for i in range(TRANSACTIONS_PER_THREAD):
+            try:
+                with Session(engine) as session, session.begin():
+                    key = f"bench-{n}-{i % 10}"
+                    kv = session.query(models.KeyValue).filter_by(keyname=key).first()
+                    if kv is None:
+                        session.add(models.KeyValue(key, str(i)))
+                    else:
+                        kv.value = str(i)
+            except OperationalError:
+                with failures_lock:
+                    failures += 1
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(THREADS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return THREADS * TRANSACTIONS_PER_THREAD / elapsed, failures
+
+
+def sqlite_engine(name: str, tuned: bool):
+    url = f"sqlite:///{os.path.join(BENCH_DIR, name)}"
+    if not tuned:
+        # pysqlite's own defaults: rollback journal, 5 second lock timeout
+        return create_engine(url)
+    engine = create_engine(url, **models.engine_options(url))
+    event.listen(engine, "connect", models.set_sqlite_pragmas)
+    return engine
+
+
+def main():
+    modes = {
+        "sqlite (defaults)": sqlite_engine("default.db", tuned=False),
+        "sqlite (WAL, busy_timeout, synchronous=NORMAL)": sqlite_engine(
+            "tuned.db", tuned=True
+        ),
+    }
+    postgres_url = os.environ.get("BENCH_POSTGRES_URL")
+    if postgres_url:
+        modes["postgresql (pooled)"] = create_engine(
+            postgres_url, **models.engine_options(postgres_url)
+        )
+
+    print(f"{THREADS} threads x {TRANSACTIONS_PER_THREAD} transactions")
+    for name, engine in modes.items():
+        throughput, failures = run_workload(engine)
+        print(f"{name:<50} {throughput:8.0f} tx/s  {failures} failed")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
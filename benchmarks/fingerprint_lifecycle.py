@@ -0,0 +1,260 @@
+"""
+Latency and database queries of the fingerprint enroll/detect/delete lifecycle
+
+A fake sensor answers the commands mattermore sends it, checking their HMAC, and
+replays the callbacks the real sensor would send: `enrolled` after an enroll and
+`deleted` after a delete. A fake lockbot records when it's told to open. Every
+iteration enrolls a fingerprint, detects it and deletes it again.
+
+The results are compared with `fingerprint_lifecycle.json` next to this file. More
+queries than the baseline, or a median more than `LATENCY_TOLERANCE` times slower,
+is a regression and makes the benchmark exit with status 1. Run with
+`--update-baseline` to accept the current results.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from unittest import mock
+
+import requests
+from sqlalchemy import event
+
+import config
+
+from benchmarks.harness import app, models
+from app import cron, devices
+from app.jobs import job_runner
+from app.routes.fingerprint import FINGERPRINT_SLOTS
+
+ITERATIONS = 50
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "fingerprint_lifecycle.json")
+# How many times slower than the baseline a median latency may be
+LATENCY_TOLERANCE = 2.0
+
+
+def fake_response(text: str = "", status: int = 200) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status
+    response._content = text.encode("utf8")
+    return response
+
+
+class FakeSensor:
+    """A fingerprint sensor that queues the callbacks it would send"""
+
+    def __init__(self, slots: int):
+        self.used = [False] * (slots + 1)
+        self.callbacks: list[str] = []
+
+    def handle(self, payload: str, signature: str) -> requests.Response:
+        expected = hmac.new(
+            config.down_key.encode("utf8"), payload.encode("utf8"), hashlib.sha256
+        )
+        assert hmac.compare_digest(expected.hexdigest().upper(), signature)
+        _timestamp, command, data = (payload.split(";") + [""])[:3]
+        if command == "list":
+            return fake_response("".join("1" if used else "0" for used in self.used))
+        if command == "enroll":
+            self.used[int(data)] = True
+            self.callbacks.append(f"enrolled\n{data}")
+        elif command == "delete":
+            self.used[int(data)] = False
+            self.callbacks.append(f"deleted\n{data}")
+        return fake_response()
+
+
+class FakeUpstream:
+    """Routes the requests mattermore sends to the fake devices"""
+
+    def __init__(self, sensor: FakeSensor):
+        self.sensor = sensor
+        self.opened_at: list[float] = []
+
+    def post(self, url, data=None, headers=None, **kwargs) -> requests.Response:
+        if url == config.fingerprint_url:
+            return self.sensor.handle(data, headers["HMAC"])
+        if url == config.lockbot_url:
+            if data.endswith(";open"):
+                self.opened_at.append(time.perf_counter())
+            return fake_response("1")
+        # Webhooks and delayed responses
+        return fake_response()
+
+
+class QueryCounter:
+    """Counts queries, those of background jobs separately from those of requests"""
+
+    def __init__(self):
+        self.counts = {"request": 0, "job": 0}
+
+    def __call__(self, *args):
+        thread = threading.current_thread().name
+        self.counts["job" if thread.startswith("job") else "request"] += 1
+
+
+@contextmanager
+def step(results: dict, name: str, queries: QueryCounter, kind: str = "request"):
+    """Record the latency and number of queries of the wrapped step"""
+
+    before = queries.counts[kind]
+    start = time.perf_counter()
+    yield
+    results[name]["latency"].append(time.perf_counter() - start)
+    results[name]["queries"].append(queries.counts[kind] - before)
+
+
+def wait_for_job(job_id: str):
+    job = job_runner.get(job_id)
+    while job.status not in ("done", "failed"):
+        time.sleep(0.0005)
+    if job.status == "failed":
+        raise RuntimeError(f"{job.name} failed")
+
+
+def run(iterations: int, upstream: FakeUpstream) -> dict:
+    sensor = upstream.sensor
+    queries = QueryCounter()
+    results = defaultdict(lambda: {"latency": [], "queries": []})
+    client = app.test_client()
+
+    with app.app_context():
+        user = models.User("fingerprinter")
+        user.mattermost_id = "mm-fingerprinter"
+        models.db.session.add(user)
+        models.db.session.commit()
+        event.listen(models.db.engine, "before_cursor_execute", queries)
+
+    command = {
+        "token": config.tokens["fingerprint"],
+        "user_id": "mm-fingerprinter",
+        "user_name": "fingerprinter",
+        "response_url": "http://mattermost.invalid/response",
+    }
+
+    def callback():
+        return client.post("/fingerprint_cb", data=sensor.callbacks.pop(0))
+
+    for i in range(iterations):
+        note = f"finger{i}"
+        enroll_start = time.perf_counter()
+        with step(results, "enroll command", queries):
+            client.post("/fingerprint", data={**command, "text": f"enroll {note}"})
+        job_id = job_runner.jobs()[-1].id
+        with step(results, "enroll job", queries, kind="job"):
+            wait_for_job(job_id)
+        fingerprint_id = sensor.callbacks[0].split("\n")[1]
+        with step(results, "enrolled callback", queries):
+            callback()
+        results["enrollment end-to-end"]["latency"].append(
+            time.perf_counter() - enroll_start
+        )
+
+        opens = len(upstream.opened_at)
+        with step(results, "detected callback", queries):
+            detected_at = time.perf_counter()
+            client.post("/fingerprint_cb", data=f"detected\n{fingerprint_id}")
+        if len(upstream.opened_at) != opens + 1:
+            raise RuntimeError("detecting a fingerprint didn't open the door")
+        results["detection to open"]["latency"].append(
+            upstream.opened_at[-1] - detected_at
+        )
+
+        with step(results, "delete command", queries):
+            client.post("/fingerprint", data={**command, "text": f"delete {note}"})
+        with step(results, "deleted callback", queries):
+            callback()
+
+    with app.app_context():
+        event.remove(models.db.engine, "before_cursor_execute", queries)
+    return results
+
+
+def summarize(results: dict) -> dict:
+    summary = {}
+    for name, values in results.items():
+        latencies = sorted(values["latency"])
+        summary[name] = {
+            "median_ms": round(statistics.median(latencies) * 1000, 3),
+            "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 3),
+        }
+        if values["queries"]:
+            summary[name]["queries"] = max(values["queries"])
+    return summary
+
+
+def compare(summary: dict, baseline: dict) -> list[str]:
+    """The regressions of `summary` compared to `baseline`"""
+
+    regressions = []
+    for name, current in summary.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if current.get("queries", 0) > expected.get("queries", 0):
+            regressions.append(
+                f"{name}: {current['queries']} queries, baseline {expected['queries']}"
+            )
+        if current["median_ms"] > expected["median_ms"] * LATENCY_TOLERANCE:
+            regressions.append(
+                f"{name}: median {current['median_ms']:.2f} ms, "
+                f"baseline {expected['median_ms']:.2f} ms"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=ITERATIONS)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    # Keep scheduled jobs from running queries in between the measured steps
+    cron.scheduler.pause()
+    upstream = FakeUpstream(FakeSensor(FINGERPRINT_SLOTS))
+    # The rate limits of the devices are deliberate delays, leave them out
+    with mock.patch.dict(
+        devices.DEVICE_RATE_LIMITS, {"fingerprint": (1e6, 1e6), "lockbot": (1e6, 1e6)}
+    ), mock.patch("requests.post", new=upstream.post):
+        summary = summarize(run(args.iterations, upstream))
+
+    try:
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+
+    print(f"{args.iterations} iterations")
+    print(f"{'step':<25} {'median':>10} {'p95':>10} {'queries':>8} {'baseline':>10}")
+    for name, current in summary.items():
+        expected = baseline.get(name, {})
+        print(
+            f"{name:<25} {current['median_ms']:7.2f} ms {current['p95_ms']:7.2f} ms "
+            f"{current.get('queries', ''):>8} "
+            f"{expected.get('median_ms', float('nan')):7.2f} ms"
+        )
+
+    if args.update_baseline:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(summary, f, indent=2)
+            f.write("\n")
+        print(f"Wrote {BASELINE_PATH}")
+        return
+
+    regressions = compare(summary, baseline)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""
+Shared setup for the benchmarks
+
+Run the benchmarks from the repository root, e.g. `python -m benchmarks.db_engine`.
+The app is imported against a throwaway SQLite database and without logging in to
+Mattermost. Upstream devices and webhooks are mocked by the benchmarks themselves.
+"""
+
+import os
+import tempfile
+import time
+from unittest import mock
+
+import config
+
+BENCH_DIR = tempfile.mkdtemp(prefix="mattermore-bench-")
+config.DATABASE_URL = f"sqlite:///{os.path.join(BENCH_DIR, 'bench.db')}"
+# Don't share the cache, device rate limits or cache snapshots with a running instance
+config.cache_path = os.path.join(BENCH_DIR, "cache.sqlite")
+config.device_lock_dir = os.path.join(BENCH_DIR, "devices")
+config.cache_snapshot_path = os.path.join(BENCH_DIR, "snapshot.json")
+# Profiling would skew the timings and write profiles next to a running instance's
+config.profile_sample_rate = 0
+# Keep the logs of every mocked upstream call out of the results
+config.log_level = "WARNING"
+
+with mock.patch("mattermostdriver.Driver.login"):
+    from app import app, models
+
+with app.app_context():
+    models.db.create_all()
+
+
+def timeit(fn, repeat: int) -> float:
+    """Average wall time of a call to `fn`, in microseconds"""
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
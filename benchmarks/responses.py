@@ -0,0 +1,58 @@
+"""
+Per-command overhead of building slash-command responses
+
+Compares serializing a response on every call with the pre-serialized static
+responses, and the /authorize listing with and without its cache.
+"""
+
+import config
+
+from benchmarks.harness import app, models, timeit
+from app.routes import door_access
+from app.util import StaticResponse, mattermost_response, orjson
+
+REPEAT = 20000
+USERS = 200
+
+MESSAGE = "Only [open|lock|status|getkey] subcommands supported"
+
+
+def main():
+    print(f"JSON encoder: {'orjson' if orjson is not None else 'json'}")
+
+    static = StaticResponse(MESSAGE, ephemeral=True)
+    dynamic_us = timeit(lambda: mattermost_response(MESSAGE, ephemeral=True), REPEAT)
+    static_us = timeit(static, REPEAT)
+    print(f"{'mattermost_response':<40} {dynamic_us:8.2f} us/call")
+    print(f"{'StaticResponse':<40} {static_us:8.2f} us/call")
+
+    with app.app_context():
+        for i in range(USERS):
+            user = models.User(f"user{i:03}", admin=i % 10 == 0)
+            user.mattermost_id = f"mm{i:03}"
+            models.db.session.add(user)
+        models.db.session.commit()
+
+        def uncached():
+            door_access.invalidate_authorized_users(None, None, None)
+            return door_access.authorized_users_response()()
+
+        uncached_us = timeit(uncached, REPEAT // 20)
+        cached_us = timeit(lambda: door_access.authorized_users_response()(), REPEAT)
+    print(f"{f'/authorize listing ({USERS} users)':<40} {uncached_us:8.2f} us/call")
+    print(f"{'/authorize listing (cached)':<40} {cached_us:8.2f} us/call")
+
+    client = app.test_client()
+    command = {
+        "token": config.tokens["door"],
+        "user_id": "mm001",
+        "user_name": "user001",
+    }
+    full_us = timeit(
+        lambda: client.post("/door", data={**command, "text": "bogus"}), REPEAT // 20
+    )
+    print(f"{'/door usage, full request':<40} {full_us:8.2f} us/call")
+
+
+if __name__ == "__main__":
+    main()
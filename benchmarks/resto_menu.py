@@ -0,0 +1,123 @@
+"""
+Rendering resto menus from the parsed Menu model versus walking the Hydra JSON
+
+The legacy functions are the dict-walking renderers the Menu model replaced, kept
+here as the baseline. Both renderers must produce identical output.
+"""
+
+import json
+
+from benchmarks.harness import timeit
+from app.cron import render_menu
+from app.menu import Menu, parse_menu
+from app.routes.resto import (
+    RESTO_TABLES,
+    RESTO_TEMPLATE,
+    UNCATEGORIZED_TEMPLATE,
+    render_resto_menu,
+)
+
+REPEAT = 5000
+
+KINDS = ["soup", "meat", "fish", "vegetarian", "vegan", "wok", "pasta"]
+TYPES = ["main", "side", "cold"]
+
+MENU_JSON = {
+    "date": "2026-10-19",
+    "open": True,
+    "meals": [
+        {
+            "name": f"Meal number {i} with a name of some length",
+            "price": f"€ {i % 7 + 1},20",
+            "kind": KINDS[i % len(KINDS)],
+            "type": TYPES[i % len(TYPES)],
+        }
+        for i in range(24)
+    ],
+    "vegetables": ["Wortelen", "Erwtjes", "Boontjes"],
+}
+
+
+def legacy_resto_menu(resto):
+    def table_for(kinds):
+        items = [meal for meal in resto["meals"] if meal["kind"] in kinds]
+        return format_items(items)
+
+    def format_items(items):
+        if not items:
+            return "None :("
+        maxwidth = max(len(item["name"]) for item in items)
+        return "\n".join(
+            "{name: <{width}}{price}".format(
+                name=item["name"], width=maxwidth + 2, price=item["price"]
+            )
+            for item in items
+        )
+
+    recognized_kinds = set.union(*RESTO_TABLES.values())
+    uncategorized_meals = [
+        meal for meal in resto["meals"] if meal["kind"] not in recognized_kinds
+    ]
+
+    uncategorized = (
+        ""
+        if not uncategorized_meals
+        else UNCATEGORIZED_TEMPLATE.format(
+            format_items(
+                [
+                    {**meal, "name": "{} ({})".format(meal["name"], meal["kind"])}
+                    for meal in uncategorized_meals
+                ]
+            )
+        )
+    )
+
+    return RESTO_TEMPLATE.format(
+        **{k: table_for(v) for k, v in RESTO_TABLES.items()},
+        uncategorized=uncategorized,
+        vegetable_table="\n".join(resto["vegetables"]),
+    )
+
+
+def legacy_render_menu(menu_json):
+    rendered = f"#### Menu voor {menu_json['date']}\n"
+
+    render_item = lambda i: f" - {i['name']}"
+
+    soups = "\n".join(
+        map(render_item, filter(lambda m: m["kind"] == "soup", menu_json["meals"]))
+    )
+    mains = "\n".join(
+        map(render_item, filter(lambda m: m["type"] == "main", menu_json["meals"]))
+    )
+    colds = "\n".join(
+        map(render_item, filter(lambda m: m["type"] == "cold", menu_json["meals"]))
+    )
+
+    rendered += f"##### Soep\n{soups}\n##### Hoofdgerecht\n{mains}\n##### Koud\n{colds}"
+    return rendered
+
+
+def main():
+    menu = Menu(MENU_JSON)
+    assert legacy_resto_menu(MENU_JSON) == render_resto_menu(menu)
+    assert legacy_render_menu(MENU_JSON) == render_menu(menu)
+
+    cached_json = json.dumps(MENU_JSON)
+    parse_menu(cached_json)
+
+    results = {
+        "/resto, dict walking": lambda: legacy_resto_menu(MENU_JSON),
+        "/resto, Menu": lambda: render_resto_menu(menu),
+        "cron, dict walking": lambda: legacy_render_menu(MENU_JSON),
+        "cron, Menu": lambda: render_menu(menu),
+        "parse Menu": lambda: Menu(MENU_JSON),
+        "parse cached Menu": lambda: parse_menu(cached_json),
+    }
+    print(f"{len(MENU_JSON['meals'])} meals")
+    for name, fn in results.items():
+        print(f"{name:<30} {timeit(fn, REPEAT):8.2f} us/call")
+
+
+if __name__ == "__main__":
+    main()
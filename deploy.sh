@@ -22,5 +22,8 @@ echo "Updating dependencies."
 echo "Migrating database."
 ~/env/bin/flask db upgrade
 
+echo "Warming up caches."
+~/env/bin/flask warmup
+
 echo "Restarting server using passenger."
 passenger-config restart-app .
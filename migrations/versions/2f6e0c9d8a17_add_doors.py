@@ -0,0 +1,33 @@
+"""Add doors besides the default door
+
+Revision ID: 2f6e0c9d8a17
+Revises: 8d1f3b7a52e4
+Create Date: 2026-10-19 17:48:13.902215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "2f6e0c9d8a17"
+down_revision = "8d1f3b7a52e4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "door",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("name", sa.String(length=32), nullable=False),
+        sa.Column("url", sa.String(length=255), nullable=False),
+        sa.Column("down_key", sa.String(length=255), nullable=False),
+        sa.Column("up_key", sa.String(length=255), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("name"),
+    )
+
+
+def downgrade():
+    op.drop_table("door")
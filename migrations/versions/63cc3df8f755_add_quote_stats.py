@@ -0,0 +1,64 @@
+"""Add quote statistics
+
+Revision ID: 63cc3df8f755
+Revises: 4ceabf7228a8
+Create Date: 2026-10-19 14:12:31.402761
+
+"""
+from alembic import op
+from collections import Counter
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "63cc3df8f755"
+down_revision = "4ceabf7228a8"
+branch_labels = None
+depends_on = None
+
+
+quote = sa.table(
+    "quote",
+    sa.column("id", sa.Integer),
+    sa.column("quoter", sa.String),
+    sa.column("quotee", sa.String),
+    sa.column("channel", sa.String),
+    sa.column("created_at", sa.DateTime),
+)
+
+
+def upgrade():
+    quote_stat = op.create_table(
+        "quote_stat",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("dimension", sa.String(length=16), nullable=False),
+        sa.Column("key", sa.String(length=255), nullable=False),
+        sa.Column("count", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("dimension", "key"),
+    )
+
+    connection = op.get_bind()
+    counts = Counter()
+    for row in connection.execute(sa.select(quote)).fetchall():
+        quotee = (row.quotee or "").strip("-_").lower() or None
+        if quotee != row.quotee:
+            connection.execute(
+                quote.update().where(quote.c.id == row.id).values(quotee=quotee)
+            )
+        counts[("quoter", row.quoter)] += 1
+        counts[("channel", row.channel)] += 1
+        if quotee is not None:
+            counts[("quotee", quotee)] += 1
+        counts[("month", row.created_at.strftime("%Y-%m"))] += 1
+    op.bulk_insert(
+        quote_stat,
+        [
+            {"dimension": dimension, "key": key, "count": count}
+            for (dimension, key), count in counts.items()
+        ],
+    )
+
+
+def downgrade():
+    op.drop_table("quote_stat")
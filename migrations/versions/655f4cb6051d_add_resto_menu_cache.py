@@ -0,0 +1,33 @@
+"""Add resto menu cache
+
+Revision ID: 655f4cb6051d
+Revises: 63cc3df8f755
+Create Date: 2026-10-19 15:03:47.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "655f4cb6051d"
+down_revision = "63cc3df8f755"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "resto_menu",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("resto", sa.String(length=32), nullable=False),
+        sa.Column("date", sa.Date(), nullable=False),
+        sa.Column("menu", sa.Text(), nullable=False),
+        sa.Column("fetched_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("resto", "date"),
+    )
+
+
+def downgrade():
+    op.drop_table("resto_menu")
@@ -0,0 +1,58 @@
+"""Add people who are quoted
+
+Revision ID: 8d1f3b7a52e4
+Revises: cacb6970ea39
+Create Date: 2026-10-19 17:05:42.318406
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "8d1f3b7a52e4"
+down_revision = "cacb6970ea39"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "person",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("name", sa.String(length=255), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(["user_id"], ["user.id"], ondelete="SET NULL"),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("name"),
+    )
+    op.create_table(
+        "person_alias",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("alias", sa.String(length=255), nullable=False),
+        sa.Column("person_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["person_id"], ["person.id"]),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("alias"),
+    )
+    op.create_index(
+        op.f("ix_person_alias_person_id"), "person_alias", ["person_id"], unique=False
+    )
+    with op.batch_alter_table("quote") as batch_op:
+        batch_op.add_column(sa.Column("person_id", sa.Integer(), nullable=True))
+        batch_op.create_index(
+            batch_op.f("ix_quote_person_id"), ["person_id"], unique=False
+        )
+        batch_op.create_foreign_key(
+            "fk_quote_person_id_person", "person", ["person_id"], ["id"]
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("quote") as batch_op:
+        batch_op.drop_constraint("fk_quote_person_id_person", type_="foreignkey")
+        batch_op.drop_index(batch_op.f("ix_quote_person_id"))
+        batch_op.drop_column("person_id")
+    op.drop_index(op.f("ix_person_alias_person_id"), table_name="person_alias")
+    op.drop_table("person_alias")
+    op.drop_table("person")
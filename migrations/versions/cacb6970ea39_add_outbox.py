@@ -0,0 +1,40 @@
+"""Add outbox for upstream events
+
+Revision ID: cacb6970ea39
+Revises: 655f4cb6051d
+Create Date: 2026-10-19 16:20:09.553120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "cacb6970ea39"
+down_revision = "655f4cb6051d"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "outbox_event",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("destination", sa.String(length=32), nullable=False),
+        sa.Column("payload", sa.Text(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("next_attempt_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_outbox_event_destination"),
+        "outbox_event",
+        ["destination"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_outbox_event_destination"), table_name="outbox_event")
+    op.drop_table("outbox_event")